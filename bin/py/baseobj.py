@@ -9,10 +9,11 @@ class BaseEnum(Enum):
         return self.value
     @classmethod
     def getType(cls,value):
-        for _, member in cls.__members__.items():
-            if member.value == value:
-                return member
-        raise Exception("Unknown enum for class %s: %s" % (cls.__name__, value) )
+        # Lookup by value uses the enum's value to member map
+        try:
+            return cls(value)
+        except ValueError:
+            raise Exception("Unknown enum for class %s: %s" % (cls.__name__, value) )
     @classmethod
     def getTypes(cls):
         """
@@ -25,11 +26,38 @@ class BaseEnum(Enum):
             result.append(member.value)
         return result
 
-class BaseObject:
+def objectDict(obj):
+    """
+        Returns a dict with the attributes of an object, whether they are kept in __slots__
+        and/or in __dict__.
+
+        For classes using __slots__, the slots starting with '_' are internal and are left out,
+        while the properties listed in the '_properties' class attribute are included.  The slots
+        not set are left out too: they are read through their descriptor, so a __getattr__ of the
+        class (e.g. the lazy loading of Device) is not called for them.
+    """
+    result = {}
+    for cls in reversed(type(obj).__mro__):
+        for name in cls.__dict__.get('__slots__', ()):
+            if name.startswith('_'):
+                continue
+            try:
+                result[name] = cls.__dict__[name].__get__(obj, cls)
+            except AttributeError:
+                pass
+    for name in getattr(type(obj), '_properties', ()):
+        result[name] = getattr(obj, name)
+    if hasattr(obj, '__dict__'):
+        result.update(obj.__dict__)
+    return result
+
+class BaseObject(object):
     """BaseObject"""
+    __slots__ = ()
+
     def __repr__(self):
         """To string representation"""
-        return "%s %s" % (self.__class__.__name__,self.__dict__)
+        return "%s %s" % (self.__class__.__name__,objectDict(self))
 
     @classmethod
     def _copyProps(cls,mapping, target, source=None, sourceDict=None):
@@ -59,9 +87,11 @@ class BaseObject:
             else:
                 raise Exception("Neither source nor sourceDict specified.")
 
-class JsonSerializable:
+class JsonSerializable(object):
+    __slots__ = ()
+
     def jsonDict(self):
-        outDict = self.__dict__.copy()
+        outDict = objectDict(self)
         for k,v in outDict.items():
             if isinstance(v,BaseEnum):
                 outDict[k] = v.value
@@ -1,8 +1,10 @@
 import os
 import yaml
 import io
-from utils import ipToHex
+from functools import partial
+from utils import ipToHex, writeFileAtomically
 from templates import Templates
+from dhcp_conf_helper import DhcpConfEntry, DhcpConfHelper
 
 REQ_IMAGE_FIELDS = [ 'name', 'file_url', 'filename', 'save_dir', 'mount_point']
 REQ_MACHINE_FIELDS = ['tag','image','yast_template']
@@ -12,6 +14,13 @@ class Config:
     'Class to load and read from image and machine configuration'
 
     DHCP_CONF = '/etc/dhcp/dhcpd.conf'
+    # Must match the 'omapi-port' in dhcpd.conf
+    DHCP_OMAPI_PORT = 7911
+    # Directory of the host entries when kept in one file per host ('reset-dhcp --host-files')
+    DHCP_HOSTS_DIR = '/etc/dhcp/hosts.d'
+    STATE_DIR = '/var/lib/bootserver'
+    SL_CACHE_FILE = STATE_DIR + '/softlayer_cache.db'
+    INVENTORY_FILE = STATE_DIR + '/inventory.json'
 
     SUBNET_ADMIN = 'admin'
     SUBNET_PUB_FLOATING = 'public_floating'
@@ -40,6 +49,8 @@ class Config:
         if 'http_root_dir' not in data['conf']:
             raise Exception("Property 'conf.http_root_dir' missing from the config file.")
         self.httpRootDir = data['conf']['http_root_dir']
+        # Optional: keep the data read from SoftLayer in a local cache between the commands
+        self.slCache = bool(data['conf'].get('sl_cache', False))
 
         # Read data from the subnets section:
         if 'subnets' not in data:
@@ -62,6 +73,8 @@ class Config:
         self.templatesDir = os.path.dirname(os.path.realpath(__file__)) + '/templates/'
         self.yastTemplatesDir = os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + "/../../yast_templates" )
         self.baseVars = { 'bootserverIP': bootserverIP, 'http_root_dir': self.httpRootDir }
+        # The DHCP templates parsed into entries, by template
+        self._dhcpPrototypes = {}
         self.images = {}
         self.machines = {}
 
@@ -170,13 +183,29 @@ class Config:
         Templates.mergeToFile(self.templatesDir + 'tftp/mount_image.sh.template', genDir + '/mount_image.sh', { })
 
     def generateInitialDhcpConf(self):
-        Templates.mergeToFile(self.templatesDir + 'dhcp/dhcpd.conf.blank', self.DHCP_CONF, { } )
-
-    def generateDhcpSubnetEntryText(self, vars):
-        return Templates.mergeToString(self.templatesDir + 'dhcp/dhcp_subnet_template.txt',vars)
-    
-    def generateDhcpHostEntryText(self, vars):
-        return Templates.mergeToString(self.templatesDir + 'dhcp/dhcp_host_template.txt',vars)
+        # The DHCP daemon may be reading the file, so it is replaced atomically
+        template = self.templatesDir + 'dhcp/dhcpd.conf.blank'
+        writeFileAtomically(self.DHCP_CONF, lambda stream: Templates.mergeToStream(template, stream, { }))
+
+    def _getDhcpPrototype(self, template, type):
+        """
+        Returns the entry of the type parsed from the template, with the variables not replaced.
+        The template is only read and parsed once.
+        """
+        if template not in self._dhcpPrototypes:
+            prototype = DhcpConfHelper().readFile(self.templatesDir + template).getRootEntry().getFirstChild(type)
+            if prototype is None:
+                raise Exception("No %s entry found in template %s" % (type.value, template))
+            self._dhcpPrototypes[template] = prototype
+        return self._dhcpPrototypes[template]
+
+    def generateDhcpSubnetEntry(self, vars):
+        """Returns a new subnet DhcpConfEntry, copied from the subnet template with the variables replaced"""
+        return self._getDhcpPrototype('dhcp/dhcp_subnet_template.txt', DhcpConfEntry.Type.Subnet).clone(partial(Templates.mergeLine, vars=vars))
+
+    def generateDhcpHostEntry(self, vars):
+        """Returns a new host DhcpConfEntry, copied from the host template with the variables replaced"""
+        return self._getDhcpPrototype('dhcp/dhcp_host_template.txt', DhcpConfEntry.Type.Host).clone(partial(Templates.mergeLine, vars=vars))
 
     def generateAutoyastFile(self, autoyastTemplate, autoyastOutFilename, vars):
         outFile = "%s/autoyast/%s" % (self.httpRootDir, autoyastOutFilename)
@@ -1,8 +1,12 @@
+import os
+import re
+import fcntl
 from collections import Sequence
-from utils import tokenize, stringToFile
-from baseobj import BaseEnum
+from StringIO import StringIO
+from utils import writeFileAtomically
+from baseobj import BaseEnum, objectDict
 
-class DhcpConfEntry:
+class DhcpConfEntry(object):
     class Type(BaseEnum):
         """
         Enumeration for the types of sections processed in a dhcpd.conf file.
@@ -26,11 +30,16 @@ class DhcpConfEntry:
      - host
 
      The entry maintains:
-      - a list of child entries per type (DhcpConfEntry) 
+      - the child entries per type (DhcpConfEntry), in the order they were added
+      - an index of the child entries per type and name, so that lookups, additions and removals
+        do not have to scan the children
       - a list of the lines contained in the entry
 
     You can search, add and remove immediate child entries based on either type and/or name, or by an entry
     """
+    __slots__ = ('type', 'name', 'parent', 'lines', 'start', 'end', '_children', '_index', '_removed', '_position')
+    _properties = ('children',)
+
     def __init__(self, type, sectionName=None, parent=None, startLine=None, endLine='}'):
         """
         Constructor for DhcpConfEntry.
@@ -53,7 +62,15 @@ class DhcpConfEntry:
         self.type = type
         self.name = sectionName
         self.parent = parent
-        self.children = {}
+        # Type name -> list of the child entries.  Removed entries are replaced by None (so that
+        # removing is O(1)) until the list is compacted.  Use getChildren/children to get them.
+        self._children = {}
+        # Type name -> name -> list of the child entries with that name (normally only one)
+        self._index = {}
+        # Type name -> number of removed entries (None) in the list of children
+        self._removed = {}
+        # Position of the entry in the list of children of its parent
+        self._position = None
         self.lines = []
         self.start = startLine
         self.end = endLine
@@ -61,7 +78,7 @@ class DhcpConfEntry:
     def __str__(self):
         """To string representation"""
         # return "Subnet{ identifier: '%s/%s', netmask: '%s', broadcast: '%s', gateway: '%s' }" % ( self.ip, self.prefix, self.netmask, self.broadcast, self.gateway)
-        return "DhcpConfEntry %s" % self.__dict__
+        return "DhcpConfEntry %s" % objectDict(self)
     def __eq__(self, other):
         """Equals function for DhcpConfEntry.  Returns true if the type and start line are the same."""
         if isinstance(other, self.__class__):
@@ -71,48 +88,124 @@ class DhcpConfEntry:
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    @property
+    def children(self):
+        """Type name -> list of the child entries, in the order they were added (without the removed ones)"""
+        return dict((key, self.getChildren(key)) for key in self._children)
+
+    @staticmethod
+    def _typeKey(typeOrName):
+        if isinstance(typeOrName, DhcpConfEntry.Type):
+            return typeOrName.name
+        return typeOrName
+
     def addChild(self,entry):
         """
         Add a child entry.  It uses the type in the entry to determine where to add the entry
         """
         key = entry.type.name
-        if key not in self.children:
-            self.children[key] = []
+        if key not in self._children:
+            self._children[key] = []
+            self._index[key] = {}
+            self._removed[key] = 0
         # Set the parent for the new entry
         entry.parent = self
         # Add the entry
-        self.children[key].append(entry)
+        entry._position = len(self._children[key])
+        self._children[key].append(entry)
+        self._index[key].setdefault(entry.name, []).append(entry)
+
+    @staticmethod
+    def _positionOf(entries, entry):
+        # By identity: different entries can be equal (same type and start line)
+        for position, other in enumerate(entries):
+            if other is entry:
+                return position
+        raise ValueError("Entry not found")
+
+    def _removeChild(self, key, child):
+        children = self._children[key]
+        children[child._position] = None
+        child._position = None
+        sameName = self._index[key][child.name]
+        del sameName[self._positionOf(sameName, child)]
+        if not sameName:
+            del self._index[key][child.name]
+
+        # Compact the list once more than half of it are removed entries
+        self._removed[key] += 1
+        if self._removed[key] * 2 > len(children):
+            children[:] = [entry for entry in children if entry is not None]
+            for position, entry in enumerate(children):
+                entry._position = position
+            self._removed[key] = 0
     
     def addLine(self,line):
         self.lines.append(line)
 
+    def clone(self, substitute=None):
+        """
+        Returns a copy of the entry and its children (the copy has no parent).
+
+         @type substitute: function
+         @param substitute: function applied to the name and the text of the entry and children
+                            in the copy (e.g. to replace variables).  Optional.
+        """
+        if substitute is None:
+            substitute = lambda text: text
+        entry = DhcpConfEntry(self.type,
+                              substitute(self.name) if self.name is not None else None,
+                              startLine=substitute(self.start) if self.start is not None else None,
+                              endLine=self.end)
+        entry.lines = [substitute(line) for line in self.lines]
+        for childTypeName in self._children:
+            for child in self.getChildren(childTypeName):
+                entry.addChild(child.clone(substitute))
+        return entry
+
     def removeChild(self, type, name=None):
         if not type:
             return False
         key = type.name
         child = self.findChild(type, name)
         if child:
-            child.parent.children[key].remove(child)
+            child.parent._removeChild(key, child)
             return True
         return False
 
+    def replaceChildEntry(self, entry):
+        """
+        Replace the child entry with the same type and name by the entry, at the same position.
+        Returns False (and does nothing) if there is no such child entry.
+        """
+        child = self.findChildEntry(entry)
+        if not child:
+            return False
+        key = entry.type.name
+        entry.parent = self
+        entry._position = child._position
+        self._children[key][child._position] = entry
+        sameName = self._index[key][child.name]
+        sameName[self._positionOf(sameName, child)] = entry
+        child._position = None
+        return True
+
     def removeChildEntry(self, entry):
         if not entry or not entry.type:
             return False
         key = entry.type.name
         child = self.findChild(entry.type, entry.name)
         if child:
-            child.parent.children[key].remove(child)
+            child.parent._removeChild(key, child)
             return True
         return False
 
     def getFirstChild(self, typeOrName): #, name=None):
-        if isinstance(typeOrName, DhcpConfEntry.Type):
-            key = typeOrName.name
-        elif isinstance(typeOrName, str):
-            key = typeOrName
-        if key in self.children:
-            return self.children[key][0]
+        key = self._typeKey(typeOrName)
+        if key in self._children:
+            for child in self._children[key]:
+                if child is not None:
+                    return child
         return None
 
     def contains(self, typeOrName, name):
@@ -138,52 +231,319 @@ class DhcpConfEntry:
         return None
 
     def getChildren(self, typeOrName):
-        if isinstance(typeOrName, DhcpConfEntry.Type):
-            key = typeOrName.name
-        elif isinstance(typeOrName, str):
-            key = typeOrName
-        return self.children[key] if key in self.children else None
+        key = self._typeKey(typeOrName)
+        return [child for child in self._children[key] if child is not None] if key in self._children else None
     
     def findChild(self, typeOrName, name=None):
-        if isinstance(typeOrName, DhcpConfEntry.Type):
-            key = typeOrName.name
-        elif isinstance(typeOrName, str):
-            key = typeOrName
-        if key in self.children:
-            # print("self.children[key]: %s" % self.children[key])
-            for child in self.children[key]:
-                # print("[Child is %s]" % child.__class__)
-                # print("[Child is %s]" % child.toText())
-                if child.name == name:
-                    # print( "Found child type %s: %s" % (child.__class__, child.toText()))
-                    return child
+        """
+        Find the (first added) child entry with the type and name.
+        """
+        key = self._typeKey(typeOrName)
+        if key in self._index and name in self._index[key]:
+            return self._index[key][name][0]
         return None
 
     def toText(self, indent=""):
+        buffer = StringIO()
+        self.write(buffer, indent)
+        return buffer.getvalue()
+
+    def write(self, stream, indent=""):
+        """
+        Write the text of the entry (and its children) to a stream, chunk by chunk, without
+        building the whole text in memory.
+
+         @type stream: file
+         @param stream: the file like object to write to
+
+         @type indent: str
+         @param indent: the indentation of the lines of the entry
+        """
         levelIndent = "  "
-        result = ""
 
         if self.start:
-            result += self.start + '\n'
+            stream.write(self.start + '\n')
         for line in self.lines:
-            result += indent + line + '\n'
-        for childTypeName in self.children:
-            entries = self.children[childTypeName]
+            stream.write(indent + line + '\n')
+        for childTypeName in self._children:
+            entries = self._children[childTypeName]
             for child in entries:
-                result += indent + child.toText(indent + levelIndent) + '\n'
+                if child is None:
+                    continue
+                stream.write(indent)
+                child.write(stream, indent + levelIndent)
+                stream.write('\n')
         if self.end:
-            # hasParent = "YES" if self.parent else "NO"
-            # hasGrandParent = "YES" if self.parent and self.parent.parent else "NO"
-            # result += "(hasParent=%s)(hasGrandParent=%s)\n" % (hasParent, hasGrandParent)
             if self.parent and self.parent.parent:
-                result += levelIndent + self.end #+ '\n'
+                stream.write(levelIndent + self.end)
+            else:
+                stream.write(self.end)
+
+class DhcpConfChange(object):
+    """
+    Class to represent the change of one entry between two DHCP configurations: the entry is either
+    added, removed or modified (its start line or its lines changed, i.e. it must be replaced as a whole).
+    """
+    class Action(BaseEnum):
+        Added = '+'
+        Removed = '-'
+        Modified = '~'
+
+    __slots__ = ('action', 'path', 'entry')
+
+    def __init__(self, action, path, entry):
+        """
+        Constructor for DhcpConfChange.
+
+         @type action: DhcpConfChange.Action
+         @param action: what changed
+
+         @type path: tuple
+         @param path: the (type name, name) of the parents of the entry, starting below the root
+
+         @type entry: DhcpConfEntry
+         @param entry: the entry added or modified (as in the new configuration), or the entry removed
+        """
+        self.action = action
+        self.path = path
+        self.entry = entry
+
+    def __str__(self):
+        if self.entry.type is None:
+            return "%s (global statements)" % self.action.value
+        return "%s %s %s" % (self.action.value, self.entry.type.value, self.entry.name)
+
+    def isHost(self):
+        return self.entry.type == DhcpConfEntry.Type.Host
+
+class DhcpConfPatch(object):
+    """
+    Class to hold the changes between two DHCP configurations (trees of DhcpConfEntry), and replay
+    them on another tree.
+
+    The entries are matched by type and name.  An entry whose start line and lines are the same in both
+    configurations is compared child by child, so adding a host in the group is one change (the host added),
+    not a change of the whole group.
+    """
+    __slots__ = ('changes',)
+
+    def __init__(self, changes=None):
+        self.changes = changes if changes is not None else []
+
+    def __str__(self):
+        return '\n'.join(str(change) for change in self.changes)
+
+    def __len__(self):
+        return len(self.changes)
+
+    def isEmpty(self):
+        return len(self.changes) == 0
+
+    def getChanges(self, type=None, action=None):
+        """Returns the changes, for the type of entries (DhcpConfEntry.Type) and/or action only if specified"""
+        return [change for change in self.changes
+                if (type is None or change.entry.type == type) and (action is None or change.action == action)]
+
+    def split(self, condition):
+        """Returns a tuple with the patch of the changes matching the condition (function), and the patch of the others"""
+        matching = DhcpConfPatch()
+        others = DhcpConfPatch()
+        for change in self.changes:
+            (matching if condition(change) else others).changes.append(change)
+        return matching, others
+
+    @staticmethod
+    def compute(oldEntry, newEntry):
+        """
+        Returns the DhcpConfPatch to go from the old entry (e.g. the root entry of a DhcpConfHelper) to the
+        new one.
+        """
+        patch = DhcpConfPatch()
+        if oldEntry.start != newEntry.start or oldEntry.lines != newEntry.lines:
+            patch.changes.append(DhcpConfChange(DhcpConfChange.Action.Modified, (), newEntry))
+        else:
+            patch._compareChildren(oldEntry, newEntry, ())
+        return patch
+
+    def _compareChildren(self, oldEntry, newEntry, path):
+        for key in sorted(set(oldEntry._children) | set(newEntry._children)):
+            oldByName = oldEntry._index.get(key, {})
+            newByName = newEntry._index.get(key, {})
+            # The removals first, so that an entry removed and added again with the same name is replaced
+            for child in oldEntry.getChildren(key) or []:
+                if child.name not in newByName:
+                    self.changes.append(DhcpConfChange(DhcpConfChange.Action.Removed, path, child))
+            for child in newEntry.getChildren(key) or []:
+                oldChildren = oldByName.get(child.name)
+                if oldChildren is None:
+                    self.changes.append(DhcpConfChange(DhcpConfChange.Action.Added, path, child))
+                    continue
+                oldChild = oldChildren[0]
+                if oldChild.start != child.start or oldChild.lines != child.lines or oldChild.end != child.end:
+                    self.changes.append(DhcpConfChange(DhcpConfChange.Action.Modified, path, child))
+                else:
+                    self._compareChildren(oldChild, child, path + ((key, child.name),))
+
+    def apply(self, root):
+        """
+        Replay the changes on a tree of entries (e.g. the root entry of a DhcpConfHelper).  Entries are added
+        and replaced with a copy of the entry of the change.
+        """
+        for change in self.changes:
+            if not change.path and change.entry.type is None:
+                root.start = change.entry.start
+                root.lines = list(change.entry.lines)
+                root._children = {}
+                root._index = {}
+                root._removed = {}
+                for key in change.entry._children:
+                    for child in change.entry.getChildren(key):
+                        root.addChild(child.clone())
+                continue
+
+            parent = root
+            for key, name in change.path:
+                parent = parent.findChild(key, name)
+                if parent is None:
+                    raise Exception("Cannot apply the change '%s': section %s %s not found" % (change, key, name))
+            if change.action == DhcpConfChange.Action.Added:
+                parent.addChild(change.entry.clone())
+            elif change.action == DhcpConfChange.Action.Removed:
+                parent.removeChildEntry(change.entry)
+            elif not parent.replaceChildEntry(change.entry.clone()):
+                parent.addChild(change.entry.clone())
+
+    def applyToHostFiles(self, hostFiles):
+        """
+        Replay the changes of the hosts on the host files (one file per host).  Returns the patch of the
+        other changes, to apply to the DHCP configuration file.
+        """
+        hostChanges, others = self.split(DhcpConfChange.isHost)
+        for change in hostChanges.changes:
+            if change.action == DhcpConfChange.Action.Removed:
+                hostFiles.removeHost(change.entry.name)
             else:
-                result += self.end #+ '\n'
-        return result
+                hostFiles.addHost(change.entry)
+        return others
+
+class DhcpHostFiles:
+    """
+    Class to manage the host entries as one file per host in a directory, instead of inside the
+    group of the dhcpd.conf file.
+
+    The group of dhcpd.conf only includes the index file of the directory, which includes the file
+    of each host.  Adding or removing a host writes (or deletes) its own file and regenerates the
+    (small) index, without reading, parsing or writing dhcpd.conf.  The changes are serialized with
+    a lock file so that concurrent processes do not lose each other's hosts in the index.
+    """
+    INDEX_FILE = 'index.conf'
+    LOCK_FILE = '.lock'
+    HOST_FILE_SUFFIX = '.conf'
+
+    def __init__(self, dirname):
+        """
+         @type dirname: str
+         @param dirname: the directory of the host files.  Created if it does not exist, as well as
+                         the index (dhcpd fails to start if the included index is missing).
+        """
+        self.dirname = os.path.abspath(dirname)
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+        if not os.path.isfile(self.getIndexFilename()):
+            lockFile = self._lock()
+            try:
+                self._writeIndex()
+            finally:
+                lockFile.close()
+
+    def getDirname(self):
+        return self.dirname
+
+    def getIndexFilename(self):
+        return os.path.join(self.dirname, self.INDEX_FILE)
+
+    def getIncludeLine(self):
+        """Returns the include statement of the index, to add in the group of dhcpd.conf"""
+        return 'include "%s";' % self.getIndexFilename()
+
+    def _hostFilename(self, hostname):
+        if not hostname or '/' in hostname or hostname.startswith('.'):
+            raise Exception("Invalid hostname for a DHCP host file: %s" % hostname)
+        return os.path.join(self.dirname, hostname + self.HOST_FILE_SUFFIX)
+
+    def _lock(self):
+        lockFile = open(os.path.join(self.dirname, self.LOCK_FILE), 'a')
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        return lockFile
+
+    def _writeIndex(self, excluded=None):
+        hostnames = [hostname for hostname in self.getHostnames() if hostname != excluded]
+        def writeIndex(stream):
+            for hostname in hostnames:
+                stream.write('include "%s";\n' % self._hostFilename(hostname))
+        writeFileAtomically(self.getIndexFilename(), writeIndex)
+
+    def getHostnames(self):
+        return sorted(filename[:-len(self.HOST_FILE_SUFFIX)] for filename in os.listdir(self.dirname)
+                      if filename.endswith(self.HOST_FILE_SUFFIX) and filename != self.INDEX_FILE and not filename.startswith('.'))
+
+    def contains(self, hostname):
+        return os.path.isfile(self._hostFilename(hostname))
+
+    def getHost(self, hostname):
+        """Returns the host entry (DhcpConfEntry) read from the file of the host, or None."""
+        if not self.contains(hostname):
+            return None
+        return DhcpConfHelper().readFile(self._hostFilename(hostname)).getRootEntry().getFirstChild(DhcpConfEntry.Type.Host)
+
+    def getHosts(self):
+        return [self.getHost(hostname) for hostname in self.getHostnames()]
+
+    def addHost(self, hostEntry):
+        """
+        Write the file of the host (replaced if it exists) and add it to the index.
+        Returns True if anything changed.
+        """
+        # The file holds a copy of the entry at the top level
+        hostConf = DhcpConfHelper()
+        hostConf.getRootEntry().addChild(hostEntry.clone())
+        lockFile = self._lock()
+        try:
+            isNew = not self.contains(hostEntry.name)
+            changed = writeFileAtomically(self._hostFilename(hostEntry.name), hostConf.write)
+            if isNew:
+                self._writeIndex()
+            return changed
+        finally:
+            lockFile.close()
+
+    def removeHost(self, hostname):
+        """
+        Remove the file of the host and remove it from the index.
+        Returns True if the host was removed, False if there was no file for it.
+        """
+        lockFile = self._lock()
+        try:
+            if not self.contains(hostname):
+                return False
+            # The index is updated first so that dhcpd never includes a missing file
+            self._writeIndex(excluded=hostname)
+            os.remove(self._hostFilename(hostname))
+            return True
+        finally:
+            lockFile.close()
 
 class DhcpConfHelper:
     """Class to help with reading and writing the dhcp.conf file"""
 
+    # Map of the section keywords to their types
+    SECTION_TYPES = dict((type.value, type) for type in DhcpConfEntry.Type)
+
+    # The tokens of the dhcpd.conf syntax: the text of a statement up to its ';', '{' or '}' (the most
+    # frequent), quoted strings (with escaped characters), comments, and the text before a string or
+    # comment.  A lone '"' is an unterminated string.
+    TOKEN_RE = re.compile(r'[^{};#"]*[{};]|"(?:[^"\\\n]|\\.)*"|#[^\n]*|[^{};#"]+|"')
+
     def __init__(self, filename=None):
         self.top = DhcpConfEntry(None, None, endLine=None)
         self.filename = filename
@@ -202,6 +562,46 @@ class DhcpConfHelper:
     def getGroup(self):
         return self.top.findChild(DhcpConfEntry.Type.Group)
 
+    def clone(self):
+        """Returns a copy of the configuration (for the same file), to change without affecting this one"""
+        copy = DhcpConfHelper()
+        copy.filename = self.filename
+        copy.top = self.top.clone()
+        return copy
+
+    def diff(self, other):
+        """Returns the DhcpConfPatch to go from this configuration to the other (DhcpConfHelper)"""
+        return DhcpConfPatch.compute(self.top, other.top)
+
+    def getHostFiles(self):
+        """
+        Returns the DhcpHostFiles if the group includes the index of a directory of host files,
+        i.e. if the host entries are kept in one file per host.  Otherwise None.
+        """
+        group = self.getGroup()
+        if group:
+            for line in group.lines:
+                if line.startswith('include ') and line.endswith('/%s";' % DhcpHostFiles.INDEX_FILE):
+                    return DhcpHostFiles(os.path.dirname(line[len('include '):-1].strip('"')))
+        return None
+
+    def enableHostFiles(self, dirname):
+        """
+        Switch to one file per host in the directory: the host entries of the group are moved to
+        their own file and the group includes the index of the directory instead.  The DHCP
+        configuration needs to be saved afterwards.  Returns the DhcpHostFiles.
+        """
+        hostFiles = DhcpHostFiles(dirname)
+        group = self.getGroup()
+        if group is None:
+            raise Exception("No group found in the DHCP configuration.")
+        for hostEntry in group.getChildren(DhcpConfEntry.Type.Host) or []:
+            hostFiles.addHost(hostEntry)
+            group.removeChildEntry(hostEntry)
+        if hostFiles.getIncludeLine() not in group.lines:
+            group.addLine(hostFiles.getIncludeLine())
+        return hostFiles
+
     @staticmethod
     def fromFile(confFile):
         return DhcpConfHelper().readFile(confFile)
@@ -218,64 +618,107 @@ class DhcpConfHelper:
          @param confFile: the path to the file containing dhcpd.conf structure
         """
         with open(confFile) as file:
-            self.readText(file.readlines())
+            self.readText(file.read())
         return self
     
     def readText(self, textOrList):
         if isinstance(textOrList,str):
-            lines = textOrList.splitlines()
+            text = textOrList
         elif isinstance(textOrList,list):
-            lines = textOrList
+            text = '\n'.join(line.rstrip('\n') for line in textOrList)
         else:
             raise Exception("Dont know how to process type '%s'. Expected either text or list of strings." % textOrList.__class__)
 
         currEntry = self.top
-        interestedIn = DhcpConfEntry.Type.getTypes() #[ 'subnet', 'shared-network', 'group', 'host' ]
-        
-        for line in lines:
-            # Remove anything passed a '#'
-            strippedLine = line.strip().split('#')[0]
-            # if !strippedLine.startswith("#") and strippedLine != "":
-            if strippedLine != "":
-                # split and stip extra spaces from the line
-                tokens = tokenize(strippedLine)
-
-                # Check first token to see if it a section start, i.e. keyword: shared-network, group, subnet, host,
-                if tokens[0] in interestedIn:
-                    # Means a new section is starting. Now determine the type
-                    type = DhcpConfEntry.Type.getType(tokens[0])
-                    if type is None:
-                        raise Exception( "Dont know how to deal with this section '%s' of line: %s" % (tokens[0], line) )
-                    # Check that the open brace, "{" is found in the line
-                    if '{' not in tokens:
-                        raise Exception( "Detected section '%s' but no trailing { found: %s" % (tokens[0], line ) )
+        lines = currEntry.lines
+        # Tokens of the statement (or section header) being read
+        tokens = []
+        # Depth in blocks that are not one of the section types (e.g. pool, class, if).  These
+        # are kept (indented) as lines of the current entry.
+        blockDepth = 0
+        blockIndent = ""
+        sectionTypes = self.SECTION_TYPES
+
+        # Single pass over the text, tokenized by one regular expression
+        for token in self.TOKEN_RE.findall(text):
+            first = token[0]
+            if first == '#':
+                # Comment
+                continue
+            last = token[-1]
+            if last == ';':
+                # End of a statement, the most frequent
+                tokens.extend(token[:-1].split())
+                lines.append(blockIndent + ' '.join(tokens) + ';')
+                tokens = []
+            elif first == '"':
+                if len(token) == 1:
+                    raise Exception("Unterminated string after: %s" % ' '.join(tokens))
+                tokens.append(token)
+            elif last == '{':
+                tokens.extend(token[:-1].split())
+                if not tokens:
+                    raise Exception("Detected { without section after: %s" % currEntry.start)
+                type = sectionTypes.get(tokens[0]) if blockDepth == 0 else None
+                if type is None:
+                    # Not a section we deal with, keep it as is
+                    lines.append(blockIndent + ' '.join(tokens) + ' {')
+                    blockDepth += 1
+                    blockIndent = "  " * blockDepth
+                else:
                     # Now the name if any specified
-                    name = None
-                    if tokens[1] != '{':
-                        name = tokens[1]
-                    # Now that we have type, name and have verified it is ok, we create the new entry
-                    newEntry = DhcpConfEntry(type, name, startLine=' '.join(tokens))
-                    # newEntry = DhcpConfEntry(type, name, currEntry, startLine=' '.join(tokens), endLine='}')
+                    name = tokens[1] if len(tokens) > 1 else None
+                    # The name can be quoted (e.g. host "name"), it is kept without the quotes
+                    if name is not None and name[0] == '"':
+                        name = name[1:-1]
+                    newEntry = DhcpConfEntry(type, name, startLine=' '.join(tokens) + ' {')
                     # Added into the chain
                     currEntry.addChild(newEntry)
                     # Make it the current entry
                     currEntry = newEntry
-                elif tokens[0] == '}':
-                    # ending a token, so set current to the parent.
-                    currEntry = currEntry.parent
+                    lines = currEntry.lines
+                tokens = []
+            elif last == '}':
+                tokens.extend(token[:-1].split())
+                if tokens:
+                    # Statement without a trailing ';'
+                    lines.append(blockIndent + ' '.join(tokens))
+                    tokens = []
+                if blockDepth > 0:
+                    blockDepth -= 1
+                    blockIndent = "  " * blockDepth
+                    lines.append(blockIndent + '}')
+                elif currEntry is self.top:
+                    raise Exception("Unexpected } at the top level")
                 else:
-                    currEntry.addLine(' '.join(tokens))
-        if currEntry != self.top:
-            raise Exception( "Section '%s' does not seem to have closed: %s" % (currEntry.type.value[0], currEntry.start))
+                    # ending a section, so set current to the parent.
+                    currEntry = currEntry.parent
+                    lines = currEntry.lines
+            else:
+                # Text followed by a string or comment
+                tokens.extend(token.split())
+        if tokens:
+            lines.append(blockIndent + ' '.join(tokens))
+        if currEntry is not self.top or blockDepth > 0:
+            raise Exception( "Section '%s' does not seem to have closed: %s" % (currEntry.type.value if currEntry.type else None, currEntry.start))
         return self
-    
+
     def toText(self):
         return self.top.toText()
+    def write(self, stream):
+        self.top.write(stream)
     def writeFile(self, confFile):
-        stringToFile(confFile, self.toText())
+        """
+        Write the configuration to a file, atomically.  The file is not touched if its content is
+        already the same.  Returns True if the file changed.
+        """
+        return writeFileAtomically(confFile, self.write)
     
     def save(self):
+        """
+        Save the configuration to the file it was read from.  Returns True if the file changed,
+        i.e. False when there was nothing to save (or no file).
+        """
         if self.filename:
-            stringToFile(self.filename, self.toText())
-            return True
+            return self.writeFile(self.filename)
         return False
@@ -0,0 +1,215 @@
+import socket
+import struct
+from pypureomapi import Omapi, OmapiMessage, OmapiError, OMAPI_OP_UPDATE, OMAPI_OP_STATUS, pack_mac, pack_ip
+from dhcp_conf_helper import DhcpConfEntry, DhcpConfChange
+
+class DhcpOmapiException(Exception):
+    """ Exception raised when the DHCP daemon cannot be updated through OMAPI """
+    def __init__(self, msg):
+        self.msg = msg
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.msg)
+
+    def __str__(self):
+        return '%s: %s' % (self.__class__.__name__, self.msg)
+
+class DhcpOmapiHelper:
+    """
+    Class to add and remove the host entries in the running DHCP daemon through its OMAPI port, so that
+    host changes do not need a restart of the daemon (which drops the DHCP exchanges of the other hosts
+    being installed).
+
+    The daemon does not write these changes to dhcpd.conf, so the DHCP configuration file must still
+    be saved as well.  It persists them in its leases file (dhcpd.leases) instead: a host added through
+    OMAPI is loaded again by a restart, even if it is no longer in dhcpd.conf, so it must be removed
+    through OMAPI as well.  Only hosts can be changed this way: a new subnet needs a restart.
+
+    The host objects of the daemon do not inherit the statements of the group the host is declared in
+    (e.g. next-server and filename for PXE), so they are sent with the statements of the host.
+    """
+    DEFAULT_PORT = 7911
+
+    # Other name of a host object in the daemon, used while it is replaced (see addHost)
+    REPLACEMENT_SUFFIX = '-replacement'
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, keyName=None, key=None, timeout=10):
+        """
+        Constructor for DhcpOmapiHelper.  The connection is opened on first use.
+
+         @type host: str
+         @param host: the host running the DHCP daemon
+
+         @type port: int
+         @param port: the OMAPI port ('omapi-port' in dhcpd.conf)
+
+         @type keyName: str
+         @param keyName: the name of the OMAPI key ('omapi-key' in dhcpd.conf), if any
+
+         @type key: str
+         @param key: the secret (base64) of the OMAPI key, if any
+
+         @type timeout: float
+         @param timeout: the timeout (seconds) of the connection
+        """
+        self.host = host
+        self.port = port
+        self.keyName = keyName
+        self.key = key
+        self.timeout = timeout
+        self._omapi = None
+
+    def _getConnection(self):
+        if self._omapi is None:
+            try:
+                self._omapi = Omapi(self.host, self.port, self.keyName, self.key, timeout=self.timeout)
+            except (OmapiError, socket.error) as e:
+                raise DhcpOmapiException("Unable to connect to the DHCP daemon OMAPI port %s:%s: %s" % (self.host, self.port, e))
+        return self._omapi
+
+    def _query(self, message):
+        try:
+            return self._getConnection().query_server(message)
+        except (OmapiError, socket.error) as e:
+            # The connection cannot be reused after an error
+            self.close()
+            raise DhcpOmapiException("OMAPI request to the DHCP daemon failed: %s" % e)
+
+    def close(self):
+        if self._omapi is not None:
+            try:
+                self._omapi.close()
+            finally:
+                self._omapi = None
+
+    def _openHost(self, hostname):
+        """
+        Returns the handle of the host object with that name in the daemon, or None if not found.
+        """
+        message = OmapiMessage.open(b"host")
+        message.obj.append((b"name", hostname))
+        response = self._query(message)
+        if response.opcode != OMAPI_OP_UPDATE or response.handle == 0:
+            return None
+        return response.handle
+
+    def _findHost(self, hostname):
+        """
+        Returns the name (the hostname or its replacement name) and the handle of the host object in the
+        daemon, or (None, None) if not found.
+        """
+        for name in (hostname, hostname + self.REPLACEMENT_SUFFIX):
+            handle = self._openHost(name)
+            if handle is not None:
+                return name, handle
+        return None, None
+
+    def hasHost(self, hostname):
+        return self._findHost(hostname)[1] is not None
+
+    @staticmethod
+    def _getScopeStatements(hostEntry):
+        """
+        Returns the statements of the groups the host entry is declared in, from the outermost one.
+        The blocks kept as lines (e.g. if) and the includes (e.g. of the host files) are left out.
+        """
+        statements = []
+        parent = hostEntry.parent
+        while parent is not None and parent.type == DhcpConfEntry.Type.Group:
+            groupStatements = [line for line in parent.lines
+                               if line.endswith(';') and not line.startswith(' ') and not line.startswith('include ')]
+            statements = groupStatements + statements
+            parent = parent.parent
+        return statements
+
+    def addHost(self, hostEntry):
+        """
+        Create the host in the daemon from a host entry of the DHCP configuration.  A host with the same
+        name is replaced.
+
+         @type hostEntry: DhcpConfEntry
+         @param hostEntry: the host entry, with its 'hardware ethernet' and 'fixed-address' statements.
+                           The other statements (e.g. filename) are passed to the daemon as is, after
+                           the statements of its group(s) if the entry is in the DHCP configuration.
+
+        A host already in the daemon is not deleted before the new one is created, so that the host is
+        always known by the daemon: the new host object is created under the other name (the hostname or
+        the hostname with REPLACEMENT_SUFFIX), then the previous one is deleted.
+        """
+        if hostEntry.type != DhcpConfEntry.Type.Host:
+            raise DhcpOmapiException("Not a host entry: %s" % hostEntry.start)
+
+        mac = None
+        ip = None
+        statements = self._getScopeStatements(hostEntry)
+        for line in hostEntry.lines:
+            tokens = line.rstrip(';').split()
+            if len(tokens) == 3 and tokens[0] == 'hardware' and tokens[1] == 'ethernet':
+                mac = tokens[2]
+            elif len(tokens) == 2 and tokens[0] == 'fixed-address':
+                ip = tokens[1]
+            else:
+                statements.append(line)
+        if mac is None:
+            raise DhcpOmapiException("No hardware ethernet address for host '%s'" % hostEntry.name)
+
+        currentName, currentHandle = self._findHost(hostEntry.name)
+        name = hostEntry.name
+        if currentName == name:
+            name = hostEntry.name + self.REPLACEMENT_SUFFIX
+            # Left by an interrupted replacement, the current host is kept until the new one is created
+            leftoverHandle = self._openHost(name)
+            if leftoverHandle is not None:
+                self._deleteHost(leftoverHandle, hostEntry.name)
+
+        message = OmapiMessage.open(b"host")
+        message.message.append((b"create", struct.pack("!I", 1)))
+        message.message.append((b"exclusive", struct.pack("!I", 1)))
+        message.obj.append((b"name", name))
+        try:
+            message.obj.append((b"hardware-address", pack_mac(mac)))
+            message.obj.append((b"hardware-type", struct.pack("!I", 1)))
+            if ip:
+                message.obj.append((b"ip-address", pack_ip(ip)))
+        except ValueError as e:
+            raise DhcpOmapiException("Invalid address for host '%s': %s" % (hostEntry.name, e))
+        if statements:
+            message.obj.append((b"statements", ' '.join(statements)))
+
+        response = self._query(message)
+        if response.opcode != OMAPI_OP_UPDATE:
+            raise DhcpOmapiException("DHCP daemon refused to add host '%s'" % hostEntry.name)
+        # The daemon has both host objects (with the same MAC) until the previous one is deleted
+        if currentHandle is not None:
+            self._deleteHost(currentHandle, hostEntry.name)
+        return True
+
+    def _deleteHost(self, handle, hostname):
+        response = self._query(OmapiMessage.delete(handle))
+        if response.opcode != OMAPI_OP_STATUS:
+            raise DhcpOmapiException("DHCP daemon refused to remove host '%s'" % hostname)
+
+    def removeHost(self, hostname):
+        """
+        Remove the host from the daemon.  Returns True if removed, False if the daemon did not have it.
+        """
+        removed = False
+        # Both names, in case a replacement was interrupted
+        for name in (hostname, hostname + self.REPLACEMENT_SUFFIX):
+            handle = self._openHost(name)
+            if handle is not None:
+                self._deleteHost(handle, hostname)
+                removed = True
+        return removed
+
+    def applyPatch(self, patch):
+        """
+        Replay the changes of the hosts of a DhcpConfPatch in the daemon.  Returns the patch of the other
+        changes, which are only loaded by a restart of the daemon.
+        """
+        hostChanges, others = patch.split(DhcpConfChange.isHost)
+        for change in hostChanges.changes:
+            if change.action == DhcpConfChange.Action.Removed:
+                self.removeHost(change.entry.name)
+            else:
+                self.addHost(change.entry)
+        return others
@@ -0,0 +1,309 @@
+import os
+import json
+import time
+from functools import partial
+from softlayer_helper import SoftLayerHelper, Device, Subnet, SubnetIndex, VLAN, IpAddress, ObjectNotFoundException, MoreThanOneMatchFoundException
+from utils import jsonToStr, writeFileAtomically
+
+class Inventory:
+    """
+    Local snapshot of the SoftLayer devices, VLANs, subnets and IPs (with their notes).
+
+    The snapshot is kept as a JSON file and loaded in memory with hash indexes by hostname, tag, MAC,
+    device id and IP note.  It provides the same lookup methods as SoftLayerHelper used by the commands
+    (getDevicesByHostname, getDevicesByTag, getSubnet, getSubnetForIP, findIpsByNotesInSubnet, ...) so it
+    can be used in its place to plan without calling the API.  The devices, subnets and IPs not in the
+    snapshot raise ObjectNotFoundException.
+
+    The devices are kept by type and id, since the baremetal and virtual devices have separate ids.  The
+    IP notes set by 'reserve' are updated in the snapshot (see updateIpNotes).
+
+    The file contains the root passwords of the devices, so it is only readable by its owner.
+    """
+    # Version of the file format
+    VERSION = 2
+
+    # Devices modified after the previous sync minus this margin (seconds) are refreshed by an
+    # incremental sync.  Covers the difference between the local and the API time zones.
+    MODIFY_DATE_MARGIN = 24 * 3600
+
+    DEVICE_MASK = Device.MASK + ",modifyDate"
+
+    # Number of items retrieved per page by the list calls of a sync
+    PAGE_SIZE = 100
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lastSync = None
+        self.devices = {}
+        self.vlans = {}
+        self.subnets = {}
+        self.ips = {}
+        if os.path.isfile(filename):
+            self.load()
+        self._buildIndexes()
+
+    def getFilename(self):
+        return self.filename
+
+    def isEmpty(self):
+        return self.lastSync is None
+
+    @staticmethod
+    def _deviceKey(data):
+        return (data['deviceType'], data['id'])
+
+    def load(self):
+        with open(self.filename) as stream:
+            data = jsonToStr(json.load(stream))
+        if data.get('version') != self.VERSION:
+            raise Exception("Unsupported inventory version in %s: %s. Run 'inventory sync --full' to create it again." % (self.filename, data.get('version')))
+        self.lastSync = data['lastSync']
+        # The devices are kept as a list, the other JSON keys are always strings so they are turned back into ids
+        self.devices = dict((self._deviceKey(dev), dev) for dev in data['devices'])
+        self.vlans = dict((int(k), v) for k, v in data['vlans'].items())
+        self.subnets = dict((int(k), v) for k, v in data['subnets'].items())
+        self.ips = dict((int(k), v) for k, v in data['ips'].items())
+        return self
+
+    def save(self):
+        data = {
+            'version': self.VERSION,
+            'lastSync': self.lastSync,
+            'devices': list(self.devices.values()),
+            'vlans': self.vlans,
+            'subnets': self.subnets,
+            'ips': self.ips
+        }
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        writeFileAtomically(self.filename, partial(json.dump, data), mode=0o600)
+
+    #
+    # Sync
+    #
+    def sync(self, slHelper, subnetIds, full=False):
+        """
+        Refresh the snapshot from SoftLayer.
+
+         @type slHelper: SoftLayerHelper
+         @param slHelper: the helper used to call the API
+
+         @type subnetIds: list
+         @param subnetIds: the ids of the subnets for which the IPs (and notes) are retrieved
+
+         @type full: bool
+         @param full: if True, all the devices are retrieved again.  Otherwise, only the devices
+                      modified since the previous sync are retrieved (and removed ones are dropped).
+
+        Returns a dict with the number of devices updated and removed.
+        """
+        syncStart = time.time()
+        incremental = not full and self.lastSync is not None
+        client = slHelper.getClient()
+
+        deviceQueries = [
+            (Device.Type.BareMetal, 'getHardware', 'hardware'),
+            (Device.Type.VM, 'getVirtualGuests', 'virtualGuests')
+        ]
+        calls = []
+        for deviceType, method, objectName in deviceQueries:
+            filter = None
+            if incremental:
+                since = time.strftime('%m/%d/%Y %H:%M:%S', time.localtime(self.lastSync - self.MODIFY_DATE_MARGIN))
+                filter = {
+                    objectName: {
+                        'modifyDate': {
+                            'operation': 'greaterThanDate',
+                            'options': [{'name': 'date', 'value': [since]}]
+                        }
+                    }
+                }
+                # The ids of all the devices, to find the ones removed
+                calls.append(partial(self._listAll, client, 'Account', method, mask='id'))
+            calls.append(partial(self._listAll, client, 'Account', method, filter=filter, mask=self.DEVICE_MASK))
+        calls.append(partial(self._listAll, client, 'Account', 'getNetworkVlans', mask=VLAN.MASK))
+        for subnetId in subnetIds:
+            calls.append(partial(self._listAll, client, 'SoftLayer_Network_Subnet', 'getIpAddresses', id=subnetId, mask=IpAddress.MASK))
+        results = slHelper.runConcurrently(calls)
+
+        devices = self.devices if incremental else {}
+        updated = 0
+        removed = 0
+        for deviceType, method, objectName in deviceQueries:
+            if incremental:
+                existingKeys = set((deviceType.value, dev['id']) for dev in results.pop(0))
+                for key in list(devices.keys()):
+                    if key[0] == deviceType.value and key not in existingKeys:
+                        del devices[key]
+                        removed += 1
+            for dev in results.pop(0):
+                dev['deviceType'] = deviceType.value
+                devices[self._deviceKey(dev)] = dev
+                updated += 1
+
+        vlans = {}
+        subnets = {}
+        for vlan in results.pop(0):
+            vlans[vlan['id']] = vlan
+            for subnet in vlan['subnets']:
+                subnets[subnet['id']] = subnet
+        ips = {}
+        for subnetId in subnetIds:
+            ips[subnetId] = results.pop(0)
+
+        self.devices = devices
+        self.vlans = vlans
+        self.subnets = subnets
+        self.ips = ips
+        self.lastSync = syncStart
+        self._buildIndexes()
+        return {'updated': updated, 'removed': removed}
+
+    @classmethod
+    def _listAll(cls, client, service, method, **kwargs):
+        return list(SoftLayerHelper.iterAll(client, service, method, cls.PAGE_SIZE, **kwargs))
+
+    def updateIpNotes(self, ipAddrs):
+        """
+        Update the notes of IPs (IpAddress) changed in SoftLayer, i.e. by 'reserve', so the snapshot is not
+        stale.  The IPs of the subnets not in the snapshot are ignored.  Returns the number of IPs updated.
+        """
+        byId = dict((ipAddr.id, ipAddr) for ipAddr in ipAddrs)
+        updated = 0
+        for ips in self.ips.values():
+            for ipdata in ips:
+                if ipdata['id'] in byId:
+                    ipdata['note'] = byId[ipdata['id']].note
+                    updated += 1
+        if updated > 0:
+            self._buildIndexes()
+        return updated
+
+    #
+    # Indexes
+    #
+    def _buildIndexes(self):
+        self._devices = {}
+        # id() of the device object -> device type
+        self._deviceTypes = {}
+        self._byHostname = {}
+        self._byTag = {}
+        self._byMac = {}
+        for key, data in self.devices.items():
+            device = Device(data)
+            self._devices[key] = device
+            self._deviceTypes[id(device)] = key[0]
+            self._byHostname.setdefault(device.hostname, []).append(device)
+            for tag in device.tags:
+                self._byTag.setdefault(tag, []).append(device)
+            mac = getattr(device, 'mac', None)
+            if mac:
+                self._byMac[mac.lower()] = device
+
+        self._subnetIndex = SubnetIndex([Subnet(data) for data in self.subnets.values()])
+
+        self._ipsById = {}
+        self._byNote = {}
+        for subnetId, ips in self.ips.items():
+            notes = {}
+            for ipdata in ips:
+                ipAddr = IpAddress(ipdata)
+                self._ipsById[ipAddr.id] = ipAddr
+                if ipAddr.note:
+                    notes.setdefault(ipAddr.note, []).append(ipAddr)
+            self._byNote[subnetId] = notes
+
+    def _ofType(self, devices, deviceType):
+        if deviceType == Device.Type.Any:
+            return devices
+        return [device for device in devices if self._deviceTypes[id(device)] == deviceType.value]
+
+    #
+    # Lookups (same behaviour as the SoftLayerHelper methods with the same name).  The devices
+    # are kept with all their fields so the masks are ignored.
+    #
+    def getDeviceById(self, id, mask=None):
+        """Returns the baremetal device with the id, the same as SoftLayerHelper.getDeviceById"""
+        key = (Device.Type.BareMetal.value, id)
+        if key not in self._devices:
+            raise ObjectNotFoundException("Device with id '{}' not found in inventory.".format(id))
+        return self._devices[key]
+
+    def getDeviceByMac(self, mac):
+        return self._byMac.get(mac.lower())
+
+    def getDeviceByHostname(self, hostname, deviceType=Device.Type.BareMetal, datacenter=None, mask=None):
+        devices = self.getDevicesByHostname([hostname], deviceType=deviceType, datacenter=datacenter, mask=mask)
+        if devices is None:
+            return None
+        if len(devices) > 1:
+            raise MoreThanOneMatchFoundException("More than one device found with hostname '%s'" % hostname)
+        return devices[0]
+
+    def getDevicesByHostname(self, hostname, deviceType=Device.Type.Any, datacenter=None, mask=None):
+        hostnames = [hostname] if isinstance(hostname, str) else hostname
+        result = []
+        for name in hostnames:
+            result.extend(self._ofType(self._byHostname.get(name, []), deviceType))
+        return result if len(result) > 0 else None
+
+    def getDevicesByTag(self, tag, deviceType=Device.Type.Any, datacenter=None, mask=None):
+        tags = [tag] if isinstance(tag, str) else tag
+        result = []
+        found = set()
+        for name in tags:
+            for device in self._ofType(self._byTag.get(name, []), deviceType):
+                if id(device) not in found:
+                    found.add(id(device))
+                    result.append(device)
+        return result if len(result) > 0 else None
+
+    def getSubnet(self, id):
+        if id not in self.subnets:
+            raise ObjectNotFoundException("Subnet with id '{}' not found in inventory.".format(id))
+        return Subnet(self.subnets[id])
+
+    def getSubnetForIP(self, ip):
+        subnet = self._subnetIndex.find(ip)
+        if subnet is None:
+            raise ObjectNotFoundException("No subnet for IP '{}' found in inventory.".format(ip))
+        return subnet
+
+    def addSubnetIdsForIPs(self, ids):
+        # All the subnets of the inventory are indexed already
+        pass
+
+    def findIpById(self, id):
+        if id not in self._ipsById:
+            raise ObjectNotFoundException("IP with id '{}' not found in inventory.".format(id))
+        return self._ipsById[id]
+
+    def _getIps(self, id):
+        if id not in self.ips:
+            raise ObjectNotFoundException("Subnet with id '{}' not found in inventory.".format(id))
+        return [IpAddress(ipdata) for ipdata in self.ips[id]]
+
+    def getIPsInSubnet(self, id, type=None, status=None):
+        result = list(self.iterIPsInSubnet(id, type, status))
+        return result if len(result) > 0 else None
+
+    def iterIPsInSubnet(self, id, type=None, status=None, pageSize=None):
+        for ipAddr in self._getIps(id):
+            if (type == None or ipAddr.type == type) and (status == None or ipAddr.status == status):
+                yield ipAddr
+
+    def findIpByNoteInSubnet(self, id, note):
+        if id not in self._byNote:
+            raise ObjectNotFoundException("Subnet with id '{}' not found in inventory.".format(id))
+        ips = self._byNote[id].get(note, [])
+        if len(ips) > 1:
+            raise MoreThanOneMatchFoundException("More than one IP found with this note text: %s" % note )
+        return ips[0] if ips else None
+
+    def findIpsByNotesInSubnet(self, id, notes):
+        result = {}
+        for note in notes:
+            result[note] = self.findIpByNoteInSubnet(id, note)
+        return result
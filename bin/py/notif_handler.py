@@ -9,19 +9,21 @@ import sys, traceback
 from config import Config
 from utils import restartDHCP
 from dhcp_conf_helper import DhcpConfEntry, DhcpConfHelper
+from dhcp_omapi_helper import DhcpOmapiException
 
 # This class will handles any incoming requests comming from the bare metals installing SUSE
 class NotificationHandler(BaseHTTPRequestHandler):
-    _dhcpConfFilename = Config.DHCP_CONF
     _server = None
+    _scheduler = None
 
     @classmethod
     def setServer(cls, server):
         cls._server = server
 
     @classmethod
-    def setDhcpConfFilename(cls, filename):
-        cls._dhcpConfFilename = filename
+    def setScheduler(cls, scheduler):
+        """Set the DhcpRemovalScheduler that removes the hosts which completed their installation"""
+        cls._scheduler = scheduler
     
     def shutdownHandler(self):
         stopServerThread = threading.Thread(target=self._server.shutdown)
@@ -81,38 +83,194 @@ class NotificationHandler(BaseHTTPRequestHandler):
         return            
 
     def handleInstallationCompleted(self, hostname):
-        dhcpConf = DhcpConfHelper(self._dhcpConfFilename)
-        dhcpGroup = dhcpConf.getGroup()
-        success = False
-
+        """
+        Queue the removal of the host from the DHCP configuration and acknowledge right away.  The
+        removals are applied in batches by the scheduler, with one save and one restart of the DHCP
+        daemon per batch.
+        """
         try:
-            if dhcpGroup.removeChild(DhcpConfEntry.Type.Host, hostname):
-                print("DHCP configuration for host '%s' removed." % hostname)
-                if dhcpConf.save():
-                    print("\nChanges saved in %s\n" % dhcpConf.getFilename())
-                    restartDHCP()
-            else:
-                print("DHCP configuration for host '%s' not found." % hostname)
-            success = True
-            print("Processed notification from '%s' successfully" % hostname)
+            self._scheduler.removeHost(hostname)
+            print("Removal of the DHCP configuration for host '%s' scheduled." % hostname)
             self.returnAckJson()
+            return True
         except:
             print("Failure to handle event from: %s" % hostname)
             traceback.print_exc(file=sys.stdout)
             self.send_error(400, "Invalid parameter")
+            return False
 
-        # Check if there are any more server to wait for.
-        serversList = dhcpGroup.getChildren(DhcpConfEntry.Type.Host)
 
-        # Check if there are any servers left to wait for.
-        if serversList is None or len(serversList) == 0:
-            print("No more hosts to wait for.  Stopping the listener.")
-            self.shutdownHandler()
+class DhcpRemovalScheduler:
+    """
+    Removes the hosts from the DHCP configuration in batches, in a background thread.
+
+    The first removal requested starts a timer.  When it expires, all the removals requested in the
+    meantime are applied together: the configuration is read, changed and saved once, and the DHCP
+    daemon is restarted once (or the hosts are removed from it through OMAPI).  A burst of installations
+    completing at the same time then does not restart the daemon once per host.
+
+    If a batch fails, its hosts are put back with the pending removals and applied with the next batch,
+    up to MAX_RETRIES times.
+    """
+    DEFAULT_DELAY = 10
+    MAX_RETRIES = 3
+
+    def __init__(self, dhcpConfFilename=Config.DHCP_CONF, delay=DEFAULT_DELAY, omapiHelper=None, onNoHostsLeft=None):
+        """
+        Constructor for DhcpRemovalScheduler.
+
+         @type dhcpConfFilename: str
+         @param dhcpConfFilename: the DHCP configuration file
+
+         @type delay: float
+         @param delay: the time (seconds) during which the removals are collected before being applied.
+                       With 0, each removal is applied right away (still in the background).
+
+         @type omapiHelper: DhcpOmapiHelper
+         @param omapiHelper: if set, the hosts are removed from the running DHCP daemon instead of restarting it
+
+         @type onNoHostsLeft: function
+         @param onNoHostsLeft: called (without arguments) once a batch leaves no hosts in the configuration
+        """
+        self.dhcpConfFilename = dhcpConfFilename
+        self.delay = delay
+        self.omapiHelper = omapiHelper
+        self.onNoHostsLeft = onNoHostsLeft
+        self._pending = []
+        # Hostname -> number of failed batches with the host
+        self._failures = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        # Only one batch is applied at a time
+        self._flushLock = threading.Lock()
+
+    def removeHost(self, hostname):
+        with self._lock:
+            if hostname not in self._pending:
+                self._pending.append(hostname)
+            self._startTimer()
+
+    def _startTimer(self):
+        # Called with the lock held
+        if self._timer is None:
+            self._timer = threading.Timer(self.delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def cancel(self):
+        """Stop the timer and return the hostnames for which the removal was not applied"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, []
+        return pending
+
+    def flush(self, retry=True):
+        """
+        Apply the pending removals now.  Returns the hostnames still in the DHCP configuration, or None if
+        there was nothing to apply or it is not known.
+
+        If the removals fail, the hosts are retried with the next batch (unless retry is False or they
+        failed MAX_RETRIES times already).  When they are not retried, the hosts left in the DHCP
+        configuration are still checked.
+        """
+        with self._flushLock:
+            hostnames = self.cancel()
+            if not hostnames:
+                return None
+            try:
+                remaining = self._removeHosts(hostnames)
+                with self._lock:
+                    for hostname in hostnames:
+                        self._failures.pop(hostname, None)
+            except:
+                print("Failure to remove the DHCP configuration for hosts: %s" % ', '.join(hostnames))
+                traceback.print_exc(file=sys.stdout)
+                if retry and self._retryLater(hostnames):
+                    return None
+                try:
+                    remaining = self._getHostnames()
+                except:
+                    traceback.print_exc(file=sys.stdout)
+                    return None
+
+        if len(remaining) == 0 and self.onNoHostsLeft:
+            self.onNoHostsLeft()
+        return remaining
+
+    def _retryLater(self, hostnames):
+        """
+        Put the hosts of a failed batch back with the pending removals, except the ones that failed too
+        many times.  Returns True if some are retried.
+        """
+        retried = []
+        with self._lock:
+            for hostname in hostnames:
+                failures = self._failures.get(hostname, 0) + 1
+                if failures > self.MAX_RETRIES:
+                    del self._failures[hostname]
+                    print("DHCP configuration for host '%s' not removed after %s attempts. Remove it manually." % (hostname, failures))
+                else:
+                    self._failures[hostname] = failures
+                    retried.append(hostname)
+            if retried:
+                self._pending = retried + [hostname for hostname in self._pending if hostname not in retried]
+                self._startTimer()
+        if retried:
+            print("Removal retried in %s seconds for hosts: %s" % (self.delay, ', '.join(retried)))
+        return len(retried) > 0
+
+    def _getHostnames(self):
+        """Returns the hostnames in the DHCP configuration"""
+        dhcpConf = DhcpConfHelper(self.dhcpConfFilename)
+        hostFiles = dhcpConf.getHostFiles()
+        if hostFiles:
+            return hostFiles.getHostnames()
+        return [host.name for host in dhcpConf.getGroup().getChildren(DhcpConfEntry.Type.Host) or []]
+
+    def _removeHosts(self, hostnames):
+        dhcpConf = DhcpConfHelper(self.dhcpConfFilename)
+        dhcpGroup = dhcpConf.getGroup()
+        hostFiles = dhcpConf.getHostFiles()
+
+        removedHostnames = []
+        for hostname in hostnames:
+            if hostFiles.removeHost(hostname) if hostFiles else dhcpGroup.removeChild(DhcpConfEntry.Type.Host, hostname):
+                print("DHCP configuration for host '%s' removed." % hostname)
+                removedHostnames.append(hostname)
+            else:
+                print("DHCP configuration for host '%s' not found." % hostname)
+
+        if len(removedHostnames) > 0:
+            # With host files, only the files of the hosts were changed.  Otherwise, only update the
+            # DHCP daemon if the file actually changed.
+            if hostFiles or dhcpConf.save():
+                if not hostFiles:
+                    print("\nChanges saved in %s\n" % dhcpConf.getFilename())
+                self._removeLiveHosts(removedHostnames)
+            else:
+                print("No changes in %s. DHCP daemon not restarted." % dhcpConf.getFilename())
+
+        if hostFiles:
+            return hostFiles.getHostnames()
+        return [host.name for host in dhcpGroup.getChildren(DhcpConfEntry.Type.Host) or []]
+
+    def _removeLiveHosts(self, hostnames):
+        """
+        Remove the hosts from the running DHCP daemon through OMAPI if possible, otherwise restart the daemon
+        (once) to load the saved configuration.
+        """
+        if self.omapiHelper:
+            try:
+                for hostname in hostnames:
+                    self.omapiHelper.removeHost(hostname)
+                    print("Host '%s' removed from the running DHCP daemon." % hostname)
+                return
+            except DhcpOmapiException as e:
+                print("WARNING: %s. Restarting the DHCP daemon instead." % e.msg)
+        restartDHCP()
 
-        # Return the status of the processing
-        return success
-                               
-    
 # server = None
 
 # try:
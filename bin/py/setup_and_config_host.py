@@ -4,14 +4,18 @@ import sys
 import crypt
 import argparse
 import SoftLayer
+from functools import partial
 from BaseHTTPServer import HTTPServer
 
 from utils import get_ip, ipToHex, restartDHCP, restartDevice
-from softlayer_helper import SoftLayerHelper, Device, Subnet, VLAN, ObjectNotFoundException
-from dhcp_conf_helper import DhcpConfEntry, DhcpConfHelper
+from softlayer_helper import SoftLayerHelper, Device, Subnet, VLAN, ObjectNotFoundException, SoftLayerHelperException, PartialReservationException
+from softlayer_cache import SoftLayerCache
+from inventory import Inventory
+from dhcp_conf_helper import DhcpConfEntry, DhcpConfChange, DhcpConfHelper
+from dhcp_omapi_helper import DhcpOmapiHelper, DhcpOmapiException
 from templates import Templates
 from config import Config
-from notif_handler import NotificationHandler
+from notif_handler import NotificationHandler, DhcpRemovalScheduler
 
 
 PROG_ENV_VAR='PROG_NAME'
@@ -26,6 +30,14 @@ def create_parser(progName=os.environ[PROG_ENV_VAR] if PROG_ENV_VAR in os.enviro
     parser.add_argument("--sl-user", metavar="USER", help="SoftLayer username (or environment variables SL_USER and SL_USERNAME)")
     parser.add_argument("--sl-apikey", metavar="KEY", help="SoftLayer API key (or environment variable SL_APIKEY and SL_API_KEY)")
     parser.add_argument("--ip", dest="bootServerIP", metavar="IP", help="Bootserver IP to use. If not specified the current IP is used.")
+    parser.add_argument("--max-concurrency", dest="maxConcurrency", metavar="N", type=int, default=SoftLayerHelper.DEFAULT_MAX_CONCURRENCY, help="Maximum number of SoftLayer API calls to run concurrently. Default is %s" % SoftLayerHelper.DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument("--sl-connect-timeout", dest="slConnectTimeout", metavar="SECONDS", type=float, help="Timeout to connect to the SoftLayer API")
+    parser.add_argument("--sl-read-timeout", dest="slReadTimeout", metavar="SECONDS", type=float, help="Timeout to wait for a response from the SoftLayer API")
+    parser.add_argument("--sl-rate-limit", dest="slRateLimit", metavar="CALLS", type=float, default=SoftLayerHelper.DEFAULT_RATE_LIMIT, help="Maximum number of SoftLayer API calls per second (0 for no limit). Default is %s" % SoftLayerHelper.DEFAULT_RATE_LIMIT)
+    parser.add_argument("--offline", action="store_true", default=False, help="Look up devices, subnets and IPs in the local inventory (see 'inventory sync') instead of SoftLayer")
+    parser.add_argument("--cache", action="store_true", default=False, help="Keep the SoftLayer data read in a local cache (%s) for the next commands. Can also be enabled with 'conf.sl_cache' in the config file" % Config.SL_CACHE_FILE)
+    parser.add_argument("--no-cache", dest="noCache", action="store_true", default=False, help="Do not use the local cache of SoftLayer data, even if enabled in the config file")
+    parser.add_argument("--omapi", action="store_true", default=False, help="Also add/remove the hosts in the running DHCP daemon through OMAPI (port %s) instead of restarting it" % Config.DHCP_OMAPI_PORT)
 
     subparsers = parser.add_subparsers(title='Sub commands')
 
@@ -35,6 +47,7 @@ def create_parser(progName=os.environ[PROG_ENV_VAR] if PROG_ENV_VAR in os.enviro
     group_prepare.add_argument("--hostname", metavar="HOST[,HOST...]", help="hostname(s) for which to create DHCP config")
     group_prepare.add_argument("--tag", metavar="TAG[,TAG...]", help="tag(s) for which to find the hosts to create DHCP")
     parser_prepare.add_argument("--unencryptedPassword", action="store_true", default=False, help="Leave root password unencrypted in the generated autoyast file. Default is to encrypt the password")
+    parser_prepare.add_argument("--dry-run", dest="dryRun", action="store_true", default=False, help="Only print the changes to the DHCP configuration, without applying them (nor generating the autoyast files)")
     parser_prepare.set_defaults(func=prepareHosts)
 
     # create the parser for the "delete" command
@@ -43,6 +56,7 @@ def create_parser(progName=os.environ[PROG_ENV_VAR] if PROG_ENV_VAR in os.enviro
     group_delete = parser_delete.add_mutually_exclusive_group(required=True)
     group_delete.add_argument("--hostname", metavar="HOST[,HOST...]", help="hostname(s) for which to remove DHCP config")
     group_delete.add_argument("--tag", metavar="TAG[,TAG...]", help="tag(s) for which to find the hosts to remove DHCP")
+    parser_delete.add_argument("--dry-run", dest="dryRun", action="store_true", default=False, help="Only print the changes to the DHCP configuration, without applying them")
     parser_delete.set_defaults(func=deleteHosts)
 
     # create the parser for the "apply" command
@@ -51,12 +65,28 @@ def create_parser(progName=os.environ[PROG_ENV_VAR] if PROG_ENV_VAR in os.enviro
     group_apply = parser_apply.add_mutually_exclusive_group(required=False)
     group_apply.add_argument("--show", action="store_true", help="Show the current hosts configured for installation")
     group_apply.add_argument("--listenOnly", action="store_true", help="Only start the listener (in case there was a failure)")
+    parser_apply.add_argument("--restartDelay", metavar="SECONDS", type=float, default=DhcpRemovalScheduler.DEFAULT_DELAY, help="Time during which the hosts completing their installation are collected, before removing them from the DHCP configuration and restarting the DHCP daemon once (default: %(default)s)")
     parser_apply.set_defaults(func=installHosts)
 
+    # create the parser for the "reserve" command
+    parser_reserve = subparsers.add_parser('reserve', help='Reserve an IP in the admin subnet for hosts (sets the hostname as the note of a free IP)')
+    group_reserve = parser_reserve.add_mutually_exclusive_group(required=True)
+    group_reserve.add_argument("--hostname", metavar="HOST[,HOST...]", help="hostname(s) for which to reserve an IP")
+    group_reserve.add_argument("--tag", metavar="TAG[,TAG...]", help="tag(s) for which to find the hosts to reserve an IP")
+    parser_reserve.set_defaults(func=reserveHosts)
+
     # create the parser for the "resetDhcp" command
     parser_resetDhcp = subparsers.add_parser('reset-dhcp', help='Reset the DHCP service')
+    parser_resetDhcp.add_argument("--host-files", dest="hostFiles", action="store_true", default=False, help="Keep each host entry in its own file under %s (included by dhcpd.conf)" % Config.DHCP_HOSTS_DIR)
     parser_resetDhcp.set_defaults(func=resetDhcp)
 
+    # create the parser for the "inventory" command
+    parser_inventory = subparsers.add_parser('inventory', help='Manage the local inventory of SoftLayer devices, subnets and IPs')
+    inventory_subparsers = parser_inventory.add_subparsers(title='Inventory sub commands')
+    parser_inventory_sync = inventory_subparsers.add_parser('sync', help='Retrieve the devices, VLANs, subnets and IP notes from SoftLayer into the local inventory')
+    parser_inventory_sync.add_argument("--full", action="store_true", default=False, help="Retrieve all the devices again instead of only the ones modified since the last sync")
+    parser_inventory_sync.set_defaults(func=syncInventory)
+
     return parser
 
 #
@@ -105,7 +135,23 @@ def preProcessArgs(args):
     #
     # First retrieve the mentioned devices and also any existing host entries in the dhcp config
     #
-    args.slHelper = SoftLayerHelper()
+    args.slCache = None
+    if (args.cache or args.cfg.slCache) and not args.noCache:
+        try:
+            args.slCache = SoftLayerCache(Config.SL_CACHE_FILE)
+        except Exception as e:
+            print("WARNING: Unable to use the SoftLayer cache %s, continuing without it: %s" % (Config.SL_CACHE_FILE, e))
+    args.slHelper = SoftLayerHelper(maxConcurrency=args.maxConcurrency, cache=args.slCache, connectTimeout=args.slConnectTimeout, readTimeout=args.slReadTimeout, rateLimit=args.slRateLimit)
+
+    #
+    # When offline, the lookups are done in the local inventory (it provides the same lookup methods)
+    #
+    if args.offline and args.func not in (syncInventory, reserveHosts):
+        inventory = Inventory(Config.INVENTORY_FILE)
+        if inventory.isEmpty():
+            print("\nERROR: The inventory %s is empty. Run the 'inventory sync' command first." % inventory.getFilename())
+            sys.exit(1)
+        args.slHelper = inventory
 
     try:
         args.adminSubnet = args.slHelper.getSubnet(args.cfg.subnet[Config.SUBNET_ADMIN])
@@ -113,14 +159,22 @@ def preProcessArgs(args):
         print("\nERROR: Cannot find admin subnet as specified in configuration file. (subnet id=%s)" % args.cfg.subnet[Config.SUBNET_ADMIN])
         sys.exit(1)
 
+    # The other subnets of the config are retrieved on the first IP lookup that needs them, so the
+    # subnet of an IP in them is found without calling the API for each IP
+    args.slHelper.addSubnetIdsForIPs([id for name, id in args.cfg.subnet.items() if name != Config.SUBNET_ADMIN])
+
     # Load the DHCP conf into the args
     loadDhcpConf(args)
+    args.omapiHelper = DhcpOmapiHelper(port=Config.DHCP_OMAPI_PORT) if args.omapi else None
 
     if args.dhcpSharedNet is None or args.dhcpGroup is None:
         print("\nERROR: The dhcpd.conf file does have the structure expected. Run the configuration on the bootserver again.")
         sys.exit(1)
 
-    args.hosts = args.dhcpGroup.getChildren(DhcpConfEntry.Type.Host)
+    if args.dhcpHostFiles:
+        args.hosts = args.dhcpHostFiles.getHosts()
+    else:
+        args.hosts = args.dhcpGroup.getChildren(DhcpConfEntry.Type.Host)
     return args
 
 def loadDhcpConf(args):
@@ -130,23 +184,30 @@ def loadDhcpConf(args):
     args.dhcpConf = DhcpConfHelper(Config.DHCP_CONF)
     args.dhcpSharedNet = args.dhcpConf.getRootEntry().getFirstChild(DhcpConfEntry.Type.Shared_Network)
     args.dhcpGroup = args.dhcpConf.getRootEntry().findChild(DhcpConfEntry.Type.Group)
+    # When the hosts are kept in their own files, the group only includes them
+    args.dhcpHostFiles = args.dhcpConf.getHostFiles()
 
 #
 # Function: runListener
 #
-def runListener(bootServerListenPort, dhcpConf, dhcpGroup):
+def runListener(bootServerListenPort, dhcpConf, omapiHelper=None, restartDelay=DhcpRemovalScheduler.DEFAULT_DELAY):
     """
     Launches a HTTP listener to wait for updates from the servers being installed.
-    When all have been processed, then it quits.
+    When all have been processed, then it quits.  The hosts are removed from the DHCP
+    configuration in batches, every restartDelay seconds, so the DHCP daemon is restarted
+    once per batch.  If an OMAPI helper is provided, the hosts are removed from the running
+    DHCP daemon instead of restarting it.
     """
     server = None
+    scheduler = None
 
     try:
         # Create the server and define the handler to manage the incomming requests
         server = HTTPServer(('', bootServerListenPort), NotificationHandler)
         print("Started listener on port %s and waiting for servers' responses." % bootServerListenPort)
         
-        NotificationHandler.setDhcpConfFilename(dhcpConf.getFilename())
+        scheduler = DhcpRemovalScheduler(dhcpConf.getFilename(), restartDelay, omapiHelper, onNoHostsLeft=partial(stopListener, server))
+        NotificationHandler.setScheduler(scheduler)
         NotificationHandler.setServer(server)
 
         # Wait forever for incoming http requests
@@ -156,6 +217,18 @@ def runListener(bootServerListenPort, dhcpConf, dhcpGroup):
         print '^C received, shutting down the listener'
         server.socket.close()
 
+    finally:
+        # Apply the removals received since the last batch (the listener is already stopped, so
+        # a failed batch is not retried)
+        if scheduler:
+            scheduler.onNoHostsLeft = None
+            scheduler.flush(retry=False)
+
+def stopListener(server):
+    print("No more hosts to wait for.  Stopping the listener.")
+    # Called from the scheduler thread, so the listener can be waited for
+    server.shutdown()
+
 #
 # Function: getDeviceInstallTag
 #
@@ -242,8 +315,7 @@ def generateSubnetEntry(cfg, bootServerIP, subnet):
         'subnet_broadcast': subnet.broadcast,
         'subnet_gateway': subnet.gateway
     }
-    subnetText = cfg.generateDhcpSubnetEntryText(vars)
-    return DhcpConfHelper().readText(subnetText).getRootEntry().getFirstChild(DhcpConfEntry.Type.Subnet)
+    return cfg.generateDhcpSubnetEntry(vars)
 
 #
 # Function: addDhcpSubnetEntry
@@ -280,8 +352,7 @@ def generateHostEntry(cfg, ip, device, machineConf):
         'server_image': machineConf['image']
     }
 
-    hostText = cfg.generateDhcpHostEntryText(vars)
-    return DhcpConfHelper().readText(hostText).getRootEntry().getFirstChild(DhcpConfEntry.Type.Host)
+    return cfg.generateDhcpHostEntry(vars)
 
 #
 # Function: addDhcpHostEntry
@@ -316,6 +387,90 @@ def removeDhcpHostEntry(dhcpGroup, hostname):
     print("DHCP configuration for host '%s' not found." % hostname)
     return False
 
+#
+# Function: loadDhcpChanges
+#
+def loadDhcpChanges(args, hostnames):
+    """
+    Returns a copy of the DHCP configuration in which to make the changes for the hosts, so that they can
+    be compared to the current configuration (see applyDhcpChanges).  When the host entries are kept in
+    their own files, the entries of these hosts are loaded in the group of the copy.
+    """
+    dhcpConf = args.dhcpConf.clone()
+    if args.dhcpHostFiles:
+        dhcpGroup = dhcpConf.getGroup()
+        for hostname in hostnames:
+            hostEntry = args.dhcpHostFiles.getHost(hostname)
+            if hostEntry:
+                dhcpGroup.addChild(hostEntry)
+    return dhcpConf
+
+#
+# Function: applyDhcpChanges
+#
+def applyDhcpChanges(args, current, changed):
+    """
+    Applies the differences between the current and the changed DHCP configuration (both from
+    loadDhcpChanges): the hosts in their own files if host files are used and the rest in the DHCP
+    configuration file, then the hosts in the running DHCP daemon if OMAPI is used.  Only the changed
+    entries are written.  With --dry-run, the changes are only printed.
+    """
+    patch = current.diff(changed)
+    if patch.isEmpty():
+        print("No changes to the DHCP configuration.")
+        return patch
+    print("Changes to the DHCP configuration:\n%s\n" % patch)
+    if 'dryRun' in args and args.dryRun:
+        print("Dry run: the changes were not applied.")
+        return patch
+
+    others = patch.applyToHostFiles(args.dhcpHostFiles) if args.dhcpHostFiles else patch
+    if not others.isEmpty():
+        others.apply(args.dhcpConf.getRootEntry())
+        if args.dhcpConf.save():
+            print("Changes saved in %s\n" % args.dhcpConf.getFilename())
+
+    if args.omapiHelper:
+        applyLiveDhcpChanges(args.omapiHelper, patch)
+    return patch
+
+#
+# Function: applyLiveDhcpChanges
+#
+def applyLiveDhcpChanges(omapiHelper, patch):
+    """
+    Adds and removes the hosts of the changes in the running DHCP daemon through OMAPI.
+    Returns True if the daemon is up to date, False otherwise (the DHCP daemon then needs a restart).
+    """
+    # A new subnet is only loaded by a restart of the DHCP daemon (done by 'apply')
+    if not patch.split(DhcpConfChange.isHost)[1].isEmpty():
+        print("Changes other than hosts in the DHCP configuration. The DHCP daemon needs to be restarted (done by 'apply').")
+        return False
+    try:
+        omapiHelper.applyPatch(patch)
+        print("Changes applied to the running DHCP daemon.")
+        return True
+    except DhcpOmapiException as e:
+        print("WARNING: %s. The DHCP daemon needs to be restarted (done by 'apply')." % e.msg)
+        return False
+
+#
+# Function: allHostsLive
+#
+def allHostsLive(omapiHelper, hostnames):
+    """
+    Returns True if all the hosts are in the running DHCP daemon, False otherwise (or if
+    the daemon cannot be queried through OMAPI).
+    """
+    try:
+        for hostname in hostnames:
+            if not omapiHelper.hasHost(hostname):
+                return False
+        return True
+    except DhcpOmapiException as e:
+        print("WARNING: %s" % e.msg)
+        return False
+
 #
 # Function: validateDeviceTags
 #
@@ -337,11 +492,12 @@ def validateDeviceTags(valid_tags, devices):
 #
 # Function: gatherDeviceInfo
 #
-def gatherDeviceInfo(cfg, slHelper, hostnames=None, tags=None):
+def gatherDeviceInfo(cfg, slHelper, hostnames=None, tags=None, mask=Device.MASK):
     """
     Collect the device information based on either a list of hostnames or a list of tags.
     The collected data is returned in a dictionary with the hostname as the key and the
-    device as the value.
+    device as the value.  The mask selects the device fields retrieved (the tags are always
+    needed to validate the devices).
     """
     if (hostnames and tags) or (hostnames == None and tags == None):
         raise Exception("Only one of hostnames or tags must be specified.")
@@ -352,7 +508,7 @@ def gatherDeviceInfo(cfg, slHelper, hostnames=None, tags=None):
     if hostnames:
         # Get all bare metal devices with the speficied hostnames.
         # However, a bare metal should not have multiple matching tags
-        devices = slHelper.getDevicesByHostname(hostnames, Device.Type.BareMetal)
+        devices = slHelper.getDevicesByHostname(hostnames, Device.Type.BareMetal, mask=mask)
         # Make sure that we can retrieve device information for all hostnames specified.
         if devices == None or len(hostnames) != len(devices):
             missingHostnames = hostnames[:]
@@ -365,7 +521,7 @@ def gatherDeviceInfo(cfg, slHelper, hostnames=None, tags=None):
     else: # i.e. tags
         # Get all bare metal devices that have the requested tags.
         # However, a bare metal should not more than one of our configured tags
-        devices = slHelper.getDevicesByTag(tags, deviceType=Device.Type.BareMetal)
+        devices = slHelper.getDevicesByTag(tags, deviceType=Device.Type.BareMetal, mask=mask)
         validateDeviceTags(valid_tags, devices)
     
     if devices and len(devices) > 0:
@@ -390,24 +546,32 @@ def prepareHosts(args):
         hostnames = [hostname for hostname in deviceInfo]
         print("Going to configure DHCP for the following hosts: %s\n" % ', '.join(hostnames))
 
-        changesMade = 0
+        # The changes are made in a copy of the DHCP config, then only the differences are applied
+        current = loadDhcpChanges(args, hostnames)
+        changed = current.clone()
+        dhcpSharedNet = changed.getRootEntry().getFirstChild(DhcpConfEntry.Type.Shared_Network)
+        dhcpGroup = changed.getGroup()
+        dryRun = 'dryRun' in args and args.dryRun
+
         # First get the subnet for the boot server and make sure it is in the DHCP config
-        mySubnet = args.slHelper.getSubnetForIP(args.bootServerIP)
+        mySubnet = getBootServerSubnet(args)
 
         if mySubnet is None:
             print("ERROR: Cannot identify the subnet for the boot server at IP %s" % args.bootServerIP)
             return 1
         else:
             # Add the boot server's subnet if not already in the DHCP config
-            if addDhcpSubnetEntry(args.cfg, args.bootServerIP, mySubnet, args.dhcpSharedNet):
-                changesMade += 1
+            if addDhcpSubnetEntry(args.cfg, args.bootServerIP, mySubnet, dhcpSharedNet):
                 print("")
 
+        # Get the info on the reserved ips for all hosts in one go
+        reservedIps = args.slHelper.findIpsByNotesInSubnet(args.adminSubnet.id, hostnames)
+
         # Now for each host we check if an DHCP entries need to be created.
         for hostname in hostnames:
             device = deviceInfo[hostname]
             # We get the info on the reserved ip and its subnet
-            ipAddr = args.slHelper.findIpByNoteInSubnet(args.adminSubnet.id, hostname)
+            ipAddr = reservedIps[hostname]
             # Get the machine conf (image to use, etc)
             machineConf = getMachineConfForDevice(args.cfg, device)
             # Get the IP address value from the IP address
@@ -415,19 +579,17 @@ def prepareHosts(args):
             if ip and args.adminSubnet:
                 print("Hostname '%s': Reserved IP is %s and subnet %s/%s" % (hostname, ip, args.adminSubnet.network, args.adminSubnet.cidr))
                 # Add the host's subnet if not already in the DHCP config
-                if addDhcpSubnetEntry(args.cfg, args.bootServerIP, args.adminSubnet, args.dhcpSharedNet):
-                    changesMade += 1
+                addDhcpSubnetEntry(args.cfg, args.bootServerIP, args.adminSubnet, dhcpSharedNet)
 
                 # Next we check if the host entry needs to be created.
-                if addDhcpHostEntry(args.dhcpGroup, generateHostEntry(args.cfg, ip, device, machineConf)):
-                    changesMade += 1
+                hostEntry = generateHostEntry(args.cfg, ip, device, machineConf)
+                addDhcpHostEntry(dhcpGroup, hostEntry)
                 print("")
             # Always generate the autoyast file since it may have changed
-            generateAutoyastFile(args.cfg, args.bootServerIP, args.bootServerListenPort, ip, args.adminSubnet, device, machineConf, args.unencryptedPassword)
+            if not dryRun:
+                generateAutoyastFile(args.cfg, args.bootServerIP, args.bootServerListenPort, ip, args.adminSubnet, device, machineConf, args.unencryptedPassword)
 
-        if changesMade > 0:
-            if args.dhcpConf.save():
-                print("\nChanges saved in %s\n" % args.dhcpConf.getFilename())
+        applyDhcpChanges(args, current, changed)
     return 0
 
 #
@@ -439,22 +601,93 @@ def deleteHosts(args):
     """
     print("")
 
-    deviceInfo = gatherDeviceInfo(args.cfg, args.slHelper, hostnames=args.hostnames if 'hostnames' in args else None, tags=args.tags if 'tags' in args else None)
+    # Only the hostnames are needed
+    deviceInfo = gatherDeviceInfo(args.cfg, args.slHelper, hostnames=args.hostnames if 'hostnames' in args else None, tags=args.tags if 'tags' in args else None, mask=Device.IDENTITY_MASK + "," + Device.TAGS_MASK)
 
     if deviceInfo and len(deviceInfo) > 0:
-        changesMade = 0
+        # The changes are made in a copy of the DHCP config, then only the differences are applied
+        current = loadDhcpChanges(args, deviceInfo.keys())
+        changed = current.clone()
+        dhcpGroup = changed.getGroup()
         # for hostname,device in deviceInfo.items():
         for hostname in deviceInfo:
-            if removeDhcpHostEntry(args.dhcpGroup, hostname):
-                changesMade += 1
-        if changesMade > 0:
-            if args.dhcpConf.save():
-                print("\nChanges saved in %s\n" % args.dhcpConf.getFilename())
+            removeDhcpHostEntry(dhcpGroup, hostname)
+        applyDhcpChanges(args, current, changed)
     else: # No host names
         print("ERROR: No matching hosts found")
         return 1
     return 0
 
+#
+# Function: reserveHosts
+#
+def reserveHosts(args):
+    """
+    Function called by the argument parser to process the "reserve" option
+    """
+    print("")
+
+    deviceInfo = gatherDeviceInfo(args.cfg, args.slHelper, hostnames=args.hostnames if 'hostnames' in args else None, tags=args.tags if 'tags' in args else None, mask=Device.IDENTITY_MASK + "," + Device.TAGS_MASK)
+
+    if deviceInfo is None or len(deviceInfo) == 0:
+        print("ERROR: No matching hosts found")
+        return 1
+
+    hostnames = sorted(deviceInfo.keys())
+    print("Reserving IPs in subnet %s/%s for the following hosts: %s\n" % (args.adminSubnet.network, args.adminSubnet.cidr, ', '.join(hostnames)))
+    failed = {}
+    try:
+        reservedIps = args.slHelper.reserveIpsInSubnet(args.adminSubnet, hostnames)
+    except PartialReservationException as e:
+        # Some notes are set, report them as well as the failures
+        reservedIps = e.reserved
+        failed = e.failed
+    except SoftLayerHelperException as e:
+        print("ERROR: %s" % e.msg)
+        return 1
+
+    for hostname in hostnames:
+        if hostname in reservedIps:
+            print("Hostname '%s': Reserved IP is %s" % (hostname, reservedIps[hostname].value))
+        else:
+            print("ERROR: Hostname '%s': %s" % (hostname, failed[hostname]))
+
+    updateInventoryIpNotes(reservedIps.values())
+
+    if len(failed) > 0:
+        print("\nERROR: No IP reserved for %s of the hosts. Run the command again to reserve the missing ones (the hosts with an IP keep it)." % len(failed))
+        return 1
+    return 0
+
+#
+# Function: updateInventoryIpNotes
+#
+def updateInventoryIpNotes(ipAddrs):
+    """
+    Keep the notes of the local inventory (if any) up to date, for the lookups done offline
+    """
+    if not os.path.isfile(Config.INVENTORY_FILE):
+        return
+    try:
+        inventory = Inventory(Config.INVENTORY_FILE)
+        if inventory.updateIpNotes(ipAddrs) > 0:
+            inventory.save()
+            print("\nIP notes updated in the inventory %s" % inventory.getFilename())
+    except Exception as e:
+        print("\nWARNING: Unable to update the IP notes in the inventory %s, run 'inventory sync': %s" % (Config.INVENTORY_FILE, e))
+
+#
+# Function: getBootServerSubnet
+#
+def getBootServerSubnet(args):
+    """
+    Returns the subnet of the boot server's IP, or None if not found.
+    """
+    try:
+        return args.slHelper.getSubnetForIP(args.bootServerIP)
+    except ObjectNotFoundException:
+        return None
+
 #
 # Function: installHosts
 #
@@ -471,26 +704,33 @@ def installHosts(args):
                 print("\tHost: %s" % host.name)
             return 0
         else:
+            hostnames = [host.name for host in args.hosts]
+            print( "Gathering information for: %s" % ', '.join(hostnames))
+            devices = args.slHelper.getDevicesByHostname(hostnames, Device.Type.BareMetal, mask=Device.IDENTITY_MASK)
             deviceInfo = { }
-            for host in args.hosts:
-                print( "Gathering information for: %s" % host.name)
-                device = args.slHelper.getDeviceByHostname(host.name)
-                if device:
-                    deviceInfo[host.name] = device
-                else:
-                    print("ERROR: Was not able to find device info for hostname '%s" % host.name)
-                    return 1
+            if devices:
+                for device in devices:
+                    if device.hostname in deviceInfo:
+                        print("ERROR: More than one device found with hostname '%s'. Device ids: %s, %s" % (device.hostname, deviceInfo[device.hostname].id, device.id))
+                        return 1
+                    deviceInfo[device.hostname] = device
+            missingHostnames = [hostname for hostname in hostnames if hostname not in deviceInfo]
+            if len(missingHostnames) > 0:
+                print("ERROR: Was not able to find device info for these hostnames: %s" % ', '.join(missingHostnames))
+                return 1
             if 'listenOnly' not in args or args.listenOnly == False:
                 print("")
-                # Restart DHCP
-                if restartDHCP() != 0:
+                # Restart DHCP, unless all the hosts are already in the running DHCP daemon
+                if args.omapiHelper and allHostsLive(args.omapiHelper, hostnames):
+                    print("All the hosts are configured in the running DHCP daemon. No restart needed.")
+                elif restartDHCP() != 0:
                         print("ERROR: Was not able to DHCP daemon service")
                         return 1
                 for hostname,device in deviceInfo.items():
                     print( "Triggering OS install on host '%s' (SoftLayer device with id: %s)" % (hostname, device.id))
                     restartDevice(device.id)
             print("")
-            runListener(args.bootServerListenPort, args.dhcpConf, args.dhcpGroup)
+            runListener(args.bootServerListenPort, args.dhcpConf, args.omapiHelper, args.restartDelay)
             return 0
     else:
         print("ERROR: No hosts configured in DHCP configution.")
@@ -507,8 +747,14 @@ def resetDhcp(args):
     # Reload it int the args (to find the two sections).
     loadDhcpConf(args)
 
+    if 'hostFiles' in args and args.hostFiles:
+        hostFiles = args.dhcpConf.enableHostFiles(Config.DHCP_HOSTS_DIR)
+        for hostname in hostFiles.getHostnames():
+            hostFiles.removeHost(hostname)
+        print("Host entries kept in their own file under %s" % hostFiles.getDirname())
+
     # First get the subnet for the boot server and make sure it is in the DHCP config
-    mySubnet = args.slHelper.getSubnetForIP(args.bootServerIP)
+    mySubnet = getBootServerSubnet(args)
 
     if mySubnet is None:
         print("ERROR: Cannot identify the subnet for the boot server at IP %s" % args.bootServerIP)
@@ -517,14 +763,30 @@ def resetDhcp(args):
     # Add the boot server's subnet if not already in the DHCP config
     if addDhcpSubnetEntry(args.cfg, args.bootServerIP, mySubnet, args.dhcpSharedNet):
         print("Successfully added subnet entry for bootserver's subnet")
-        if args.dhcpConf.save():
-            print( "Changes saved successfully in :" + args.dhcpConf.getFilename())
-            return 0
-        else:
-            return 1
     else:
         print("Bootserver's subnet already in file.")
-        return 0
+    if args.dhcpConf.save():
+        print( "Changes saved successfully in :" + args.dhcpConf.getFilename())
+    else:
+        print( "No changes to save in :" + args.dhcpConf.getFilename())
+    return 0
+
+#
+# Function: syncInventory
+#
+def syncInventory(args):
+    """
+    Function called by the argument parser to process the "inventory sync" option
+    """
+    print("")
+    inventory = Inventory(Config.INVENTORY_FILE)
+    subnetIds = list(set(args.cfg.subnet.values()))
+
+    print("Synchronizing %s inventory: %s" % ("full" if args.full or inventory.isEmpty() else "incremental", inventory.getFilename()))
+    counts = inventory.sync(args.slHelper, subnetIds, full=args.full)
+    inventory.save()
+    print("Inventory synchronized. Devices updated: %s, devices removed: %s, VLANs: %s, subnets: %s" % (counts['updated'], counts['removed'], len(inventory.vlans), len(inventory.subnets)))
+    return 0
 
 
 #############################################################################################
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from utils import jsonToStr
+
+class SoftLayerCache:
+    """
+    Persistent cache (sqlite) for the data read from the SoftLayer API.
+
+    The entries are kept per object type, each type with its own time to live (in seconds).  The values
+    stored are the raw data returned by the API (i.e. the dicts/lists before being turned into
+    Device, Subnet, etc) so they must be JSON serializable.  Their strings are returned as str, the
+    same as read from the API.
+
+    The file is only readable by its owner.  The devices retrieved with their credentials are not cached
+    (see SoftLayerHelper).
+    """
+    class Type:
+        Device = 'device'
+        Subnet = 'subnet'
+        SubnetForIP = 'subnetForIP'
+        Vlan = 'vlan'
+        IPs = 'ips'
+
+    DEFAULT_TTLS = {
+        Type.Device: 300,
+        Type.Subnet: 3600,
+        Type.SubnetForIP: 3600,
+        Type.Vlan: 900,
+        Type.IPs: 120
+    }
+
+    def __init__(self, filename, ttls=None):
+        """
+        Constructor for SoftLayerCache.
+
+         @type filename: str
+         @param filename: the sqlite file to use.  The directory is created if it does not exist.
+
+         @type ttls: dict
+         @param ttls: time to live (seconds) per object type.  Merged into the default TTLs.
+        """
+        self.filename = filename
+        self.ttls = self.DEFAULT_TTLS.copy()
+        if ttls:
+            self.ttls.update(ttls)
+
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # Create the file (or restrict an existing one) before sqlite opens it with the default umask
+        os.close(os.open(filename, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(filename, 0o600)
+
+        # The helper reads from several threads, so the connection is shared and access is serialized.
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cache (type TEXT, key TEXT, expires REAL, value TEXT, PRIMARY KEY (type, key))")
+            self._conn.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+            self._conn.commit()
+
+    def getFilename(self):
+        return self.filename
+
+    @staticmethod
+    def toKey(*args):
+        """Build the cache key for the arguments of a call."""
+        return json.dumps(args, sort_keys=True, default=str)
+
+    def get(self, type, key):
+        """
+        Look up an entry.  Returns a tuple (found, value) since None is a valid cached value.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM cache WHERE type = ? AND key = ? AND expires > ?", (type, key, time.time())).fetchone()
+        if row is None:
+            return False, None
+        return True, jsonToStr(json.loads(row[0]))
+
+    def put(self, type, key, value):
+        if type not in self.ttls or self.ttls[type] <= 0:
+            return
+        expires = time.time() + self.ttls[type]
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO cache (type, key, expires, value) VALUES (?, ?, ?, ?)", (type, key, expires, json.dumps(value)))
+            self._conn.commit()
+
+    def invalidate(self, type, key=None):
+        """
+        Remove the entry for the key, or all the entries of the type if no key specified.
+        """
+        with self._lock:
+            if key is None:
+                self._conn.execute("DELETE FROM cache WHERE type = ?", (type,))
+            else:
+                self._conn.execute("DELETE FROM cache WHERE type = ? AND key = ?", (type, key))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,7 +1,18 @@
 import os
 import SoftLayer
+import time
+import random
 import numbers
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from SoftLayer.config import get_client_settings
+from SoftLayer.transports import XmlRpcTransport
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from baseobj import BaseEnum, BaseObject, JsonSerializable
+from softlayer_cache import SoftLayerCache
+from utils import aton, ntoa
 
 class SoftLayerHelperException(Exception):
     """ Base exception """
@@ -19,6 +30,14 @@ class ObjectNotFoundException(SoftLayerHelperException):
 class MoreThanOneMatchFoundException(SoftLayerHelperException):
     """ Exception raised when more than one match found """
 
+class PartialReservationException(SoftLayerHelperException):
+    """ Exception raised when the IPs were reserved for some of the notes only """
+    def __init__(self, msg, reserved, failed):
+        SoftLayerHelperException.__init__(self, msg)
+        # Note -> IP for the notes that have an IP, note -> reason for the others
+        self.reserved = reserved
+        self.failed = failed
+
 class IpAddress(BaseObject, JsonSerializable):
     """
         Represents an ip address
@@ -38,6 +57,56 @@ class IpAddress(BaseObject, JsonSerializable):
         HardwareDevice = "Hardware Device"
         UserDefined = "User-defined"
         # Unspecified = "Unspecified"
+
+    __slots__ = ('id', 'subnetId', '_address', 'note', 'status', 'type', 'hostname')
+    _properties = ('value',)
+
+    # Flags of the IP that make it a reserved IP (see the constructor)
+    RESERVED_FLAGS = ['isNetwork', 'isBroadcast', 'isGateway', 'isReserved']
+
+    @classmethod
+    def getFilter(cls, type=None, status=None):
+        """
+            Build the object filter clauses (for the IP properties) that narrow the IPs on the
+            server side to the specified type and/or status.
+
+            Some combinations cannot be expressed exactly as a filter (i.e. status 'Reserved' is
+            any of the reserved flags), so the filter returned is a superset and the caller is
+            still expected to check the type and status of the IPs returned.
+
+            Returns None if there is nothing to filter on.
+        """
+        filter = {}
+        if status == cls.Status.In_Use or status == cls.Status.Other:
+            for flag in cls.RESERVED_FLAGS:
+                filter[flag] = {'operation': 0}
+        if type == cls.Type.Network:
+            filter['isNetwork'] = {'operation': 1}
+        elif type == cls.Type.Broadcast:
+            filter['isBroadcast'] = {'operation': 1}
+        elif type == cls.Type.Gateway:
+            filter['isGateway'] = {'operation': 1}
+        elif type == cls.Type.Reserved:
+            filter['isReserved'] = {'operation': 1}
+        elif type == cls.Type.VirtualDevice:
+            filter['virtualGuest'] = {'id': {'operation': 'not null'}}
+        elif type == cls.Type.HardwareDevice:
+            filter['hardware'] = {'id': {'operation': 'not null'}}
+        elif type == cls.Type.UserDefined:
+            for flag in cls.RESERVED_FLAGS:
+                filter[flag] = {'operation': 0}
+        return filter if len(filter) > 0 else None
+
+    @property
+    def value(self):
+        """The IP address as string"""
+        return ntoa(self._address) if isinstance(self._address, numbers.Integral) else self._address
+
+    @value.setter
+    def value(self, ip):
+        # IPv4 addresses are kept as integers, anything else as is
+        self._address = aton(ip) if ip and ':' not in ip else ip
+
     def __init__(self, data):
         #id,ipAddress,isReserved,note
         self.id = data['id']
@@ -88,6 +157,24 @@ class Subnet(BaseObject, JsonSerializable):
         Any = "Any"
     """Entity that represent a softlayer subnet"""
     MASK = "id,networkIdentifier,netmask,broadcastAddress,gateway,addressSpace,subnetType"
+
+    __slots__ = ('id', 'network', 'netmask', 'broadcast', 'gateway', 'cidr', 'name', 'addressSpace', 'type')
+
+    @classmethod
+    def getFilter(cls, subnetType=Type.Any, addressSpace=AddressSpace.Any):
+        """
+            Build the object filter clauses (for the subnet properties) that match the specified
+            subnet type and address space.
+
+            Returns None if both are 'Any', i.e. there is nothing to filter on.
+        """
+        filter = {}
+        if subnetType is not None and subnetType != cls.Type.Any:
+            filter['subnetType'] = {'operation': subnetType.value}
+        if addressSpace is not None and addressSpace != cls.AddressSpace.Any:
+            filter['addressSpace'] = {'operation': addressSpace.value}
+        return filter if len(filter) > 0 else None
+
     @staticmethod
     def getPrefix(netmask):
         "Get the subnet prefix given the netmask"
@@ -118,10 +205,52 @@ class Subnet(BaseObject, JsonSerializable):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+class SubnetIndex:
+    """
+        Longest prefix match index of subnets, to find the subnet of an IP without calling the API.
+
+        The subnets are kept in one hash table per prefix length (network address as integer -> subnet),
+        so a lookup is at most one hash lookup per prefix length, starting with the longest.
+    """
+    def __init__(self, subnets=None):
+        self._lock = threading.Lock()
+        self._byPrefix = {}
+        self._prefixes = []
+        if subnets:
+            for subnet in subnets:
+                self.add(subnet)
+
+    def add(self, subnet):
+        # Only IPv4 subnets are indexed
+        if ':' in subnet.network:
+            return
+        netmask = aton(subnet.netmask)
+        with self._lock:
+            if subnet.cidr not in self._byPrefix:
+                self._byPrefix[subnet.cidr] = (netmask, {})
+                self._prefixes = sorted(self._byPrefix.keys(), reverse=True)
+            self._byPrefix[subnet.cidr][1][aton(subnet.network) & netmask] = subnet
+
+    def find(self, ip):
+        """Returns the most specific subnet that contains the ip (as string), or None if not known."""
+        if ':' in ip:
+            return None
+        address = aton(ip)
+        for prefix in self._prefixes:
+            netmask, subnets = self._byPrefix[prefix]
+            subnet = subnets.get(address & netmask)
+            if subnet is not None:
+                return subnet
+        return None
+
+    def __len__(self):
+        return sum(len(subnets) for _, subnets in self._byPrefix.values())
+
 class VLAN(BaseObject, JsonSerializable):
     """Entity that represents a softlayer VLAN"""
     # MASK = "id,name,vlanNumber,primaryRouter[datacenter[name]],subnets[" + Subnet.MIN_MASK + "]"
-    MASK = "id,name,vlanNumber,primaryRouter[datacenter[name]],subnets[" + Subnet.MASK + "]"
+    BASE_MASK = "id,name,vlanNumber,primaryRouter[fullyQualifiedDomainName,datacenter[name]]"
+    MASK = BASE_MASK + ",subnets[" + Subnet.MASK + "]"
     def __init__(self, detail,subnetType=Subnet.Type.Any, addressSpace=Subnet.AddressSpace.Any):
         self.name = detail['name'] if 'name' in detail else None
         self.id = detail['id']
@@ -130,6 +259,7 @@ class VLAN(BaseObject, JsonSerializable):
         self.primaryRouter = '.'.join(detail['primaryRouter']['fullyQualifiedDomainName'].split('.',2)[0:2])
 
         self.subnets = []
+        # The subnets may already be filtered by the API, but not always (i.e. when listing all VLANs)
         for slSubnet in detail['subnets']:
             subnet = Subnet(slSubnet)
             matchedType = (subnetType == Subnet.Type.Any or subnetType == subnet.type)
@@ -139,7 +269,7 @@ class VLAN(BaseObject, JsonSerializable):
                 self.subnets.append(subnet)
 
 class NetworkGateway(BaseObject, JsonSerializable):
-    MASK = "privateVlanId,publicVlanId,name,publicIpAddressId,accountId,networkSpace,id,privateIpAddressId"
+    MASK = "privateVlanId,publicVlanId,name,publicIpAddressId,accountId,networkSpace,id,privateIpAddressId,publicIpAddress[" + IpAddress.MASK + "],privateIpAddress[" + IpAddress.MASK + "]"
     """
         This class represents the NetworkGateway (vyatta)
     """
@@ -162,6 +292,8 @@ class NetworkGateway(BaseObject, JsonSerializable):
                 'networkSpace': 'BOTH',              <-- self.networkSpace
                 'id': 395403,                        <-- self.id
                 'privateIpAddressId': 117413749      <-- self.privateIP (as IP after looking it up using the id)
+                'publicIpAddress': {...},            <-- self.publicIP (used instead of the look up when present)
+                'privateIpAddress': {...}            <-- self.privateIP (used instead of the look up when present)
             }
         """
         self.name = data['name'] #if 'name' in data else None
@@ -170,36 +302,84 @@ class NetworkGateway(BaseObject, JsonSerializable):
         self.account = data['accountId']
         self.id = data['id']
         self.networkSpace = self.NetworkSpace.getType(data['networkSpace'])
-        self.publicIP = slHelper.findIpById(data['publicIpAddressId'])
-        self.privateIP = slHelper.findIpById(data['privateIpAddressId'])
+        self.publicIP = IpAddress(data['publicIpAddress']) if 'publicIpAddress' in data else slHelper.findIpById(data['publicIpAddressId'])
+        self.privateIP = IpAddress(data['privateIpAddress']) if 'privateIpAddress' in data else slHelper.findIpById(data['privateIpAddressId'])
 
 class Device(BaseObject, JsonSerializable):
     class Type(BaseEnum):
         BareMetal = "BareMetal"
         VM = "VirtualMachine"
         Any = "Any"
-    MASK = "id,hostname,domain,primaryBackendIpAddress,operatingSystem[passwords[username,password]],tagReferences[tag[name]],networkComponents[primarySubnet[" + Subnet.MASK + "]]"
-    def __init__(self, detail):
+    # Masks by use case.  The identity mask is always included, the others are picked as needed
+    # (e.g. the credentials are only needed to generate the autoyast files).
+    IDENTITY_MASK = "id,hostname,domain"
+    TAGS_MASK = "tagReferences[tag[name]]"
+    NETWORK_MASK = "primaryBackendIpAddress,networkComponents[name,port,macAddress,primarySubnet[id]]"
+    CREDENTIALS_MASK = "operatingSystem[passwords[username,password]]"
+    MASK = ",".join([IDENTITY_MASK, TAGS_MASK, NETWORK_MASK, CREDENTIALS_MASK])
+
+    # The mask retrieving each of the fields that are not part of the identity
+    FIELD_MASKS = {
+        'tags': TAGS_MASK,
+        'ip': NETWORK_MASK,
+        'mac': NETWORK_MASK,
+        'subnet': NETWORK_MASK,
+        'password': CREDENTIALS_MASK
+    }
+
+    __slots__ = ('id', 'hostname', 'domain', 'ip', 'userid', 'password', 'tags', 'mac', 'subnet', '_loader', '_loaded')
+    def __init__(self, detail, loader=None):
+        """
+        Constructor for Device.
+
+         @type detail: dict
+         @param detail: the device data returned by the API.  Only the fields in the mask used to
+                        retrieve it are set.
+
+         @type loader: function
+         @param loader: function called with the device id and a mask to retrieve the fields missing
+                        from the detail on first access.  Without loader, missing fields are not set.
+        """
+        self._loader = loader
+        self._loaded = set()
         self.id = detail['id']
         self.hostname = detail['hostname']
-        self.domain = detail['domain']
-        self.ip = detail['primaryBackendIpAddress']
+        self.domain = detail.get('domain')
         self.userid = 'root'
-        self.password = [cred['password'] for cred in detail['operatingSystem']['passwords'] if cred['username'] == self.userid][0]
-        self.tags = []
-        if detail['tagReferences']:
-            for tagRef in detail['tagReferences']:
-                if 'tag' in tagRef:
-                    self.tags.append(tagRef['tag']['name'])
-
-        for obj in detail['networkComponents']:
-            if obj['name'] == 'eth' and obj['port'] == 0:
-                self.mac = obj['macAddress']
-                #self.subnet = Subnet(obj['primarySubnet'])
-                self.subnet = obj['primarySubnet']['id']
-                break
+        self._setFields(detail)
+
+    def _setFields(self, detail):
+        if 'operatingSystem' in detail:
+            self.password = [cred['password'] for cred in detail['operatingSystem']['passwords'] if cred['username'] == self.userid][0]
+        if 'tagReferences' in detail:
+            self.tags = []
+            if detail['tagReferences']:
+                for tagRef in detail['tagReferences']:
+                    if 'tag' in tagRef:
+                        self.tags.append(tagRef['tag']['name'])
+
+        if 'networkComponents' in detail:
+            self.ip = detail.get('primaryBackendIpAddress')
+            for obj in detail['networkComponents']:
+                if obj['name'] == 'eth' and obj['port'] == 0:
+                    self.mac = obj['macAddress']
+                    #self.subnet = Subnet(obj['primarySubnet'])
+                    self.subnet = obj['primarySubnet']['id']
+                    break
         # print(self.__dict__)
 
+    def __getattr__(self, name):
+        """
+        Only called for the fields not set, i.e. not in the mask the device was retrieved with.
+        The mask for the field is retrieved (once) using the loader.
+        """
+        mask = Device.FIELD_MASKS.get(name)
+        if mask is None or self._loader is None or mask in self._loaded:
+            raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+        self._loaded.add(mask)
+        self._setFields(self._loader(self.id, mask))
+        return object.__getattribute__(self, name)
+
     def __eq__(self, other):
         """Equals function for Subnet.  Returns true if the ids are the same."""
         if isinstance(other, self.__class__):
@@ -209,22 +389,252 @@ class Device(BaseObject, JsonSerializable):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+class PooledXmlRpcTransport(XmlRpcTransport):
+    """
+        XML-RPC transport that keeps a size bounded pool of keep-alive connections to the API endpoint.
+
+        The same session (and so the same connections) is used by all the threads sharing the transport.
+        When all the connections in the pool are busy, a thread waits for one to be released instead of
+        opening an extra connection.
+    """
+    def __init__(self, poolSize, connectTimeout=None, readTimeout=None, **kwargs):
+        super(PooledXmlRpcTransport, self).__init__(**kwargs)
+        self.poolSize = poolSize
+        if connectTimeout is not None or readTimeout is not None:
+            # requests takes the (connect, read) timeouts as a tuple
+            self.timeout = (connectTimeout, readTimeout if readTimeout is not None else self.timeout)
+        self._session = requests.Session()
+        self._session.headers.update({
+            'Content-Type': 'application/json',
+            'User-Agent': self.user_agent,
+        })
+        # No retries at this level: the failed calls are retried by the RateLimitedTransport
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, pool_block=True, max_retries=0)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+    @property
+    def client(self):
+        """Returns the pooled session"""
+        return self._session
+
+    def close(self):
+        self._session.close()
+
+class TokenBucket:
+    """
+        Token bucket rate limiter shared by all the threads issuing API calls.
+    """
+    def __init__(self, rate, capacity=None):
+        """
+         @type rate: float
+         @param rate: the number of tokens added per second (i.e. calls per second).  0 for no limit.
+
+         @type capacity: float
+         @param capacity: the maximum number of tokens (i.e. the burst size).  Defaults to the rate.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity else max(rate, 1))
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def setRate(self, rate):
+        with self._lock:
+            self._refill()
+            self.rate = float(rate)
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Take a token, waiting until one is available."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class RateLimitedTransport:
+    """
+        Transport wrapper that every API call goes through.  It:
+         - limits the rate of the calls with a token bucket
+         - limits the number of calls in flight, halving the limit when the API throttles and
+           growing it back one at a time after a run of successful calls
+         - retries throttled calls, and transient faults of read-only calls, with exponential backoff and jitter
+
+        Once the retries are exhausted, the last error is raised as is.
+    """
+    # HTTP status codes considered transient (0 is used for connection errors)
+    TRANSIENT_STATUS = [0, 500, 502, 503, 504]
+    # Number of successful calls before the concurrency limit and rate are raised again
+    RECOVERY_CALLS = 20
+
+    def __init__(self, transport, maxConcurrency, rate, maxRetries=5, baseDelay=0.5, maxDelay=30):
+        self.transport = transport
+        self.maxConcurrency = max(maxConcurrency, 1)
+        self.maxRate = float(rate)
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.bucket = TokenBucket(rate)
+        self._limit = self.maxConcurrency
+        self._inFlight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+        self.stats = {'calls': 0, 'retries': 0, 'throttled': 0, 'failures': 0}
+
+    @staticmethod
+    def isThrottled(error):
+        if isinstance(error, SoftLayer.TransportError) and error.faultCode == 429:
+            return True
+        return isinstance(error, SoftLayer.SoftLayerAPIError) and 'RateLimit' in str(error.faultCode)
+
+    @classmethod
+    def isTransient(cls, error):
+        return isinstance(error, SoftLayer.TransportError) and error.faultCode in cls.TRANSIENT_STATUS
+
+    @staticmethod
+    def isReadOnly(request):
+        return request.method.startswith('get')
+
+    def getStats(self):
+        """Returns a copy of the call counters and the current limits."""
+        with self._cond:
+            stats = self.stats.copy()
+            stats['concurrencyLimit'] = self._limit
+            stats['rate'] = self.bucket.rate
+        return stats
+
+    def _enter(self):
+        with self._cond:
+            while self._inFlight >= self._limit:
+                self._cond.wait()
+            self._inFlight += 1
+            self.stats['calls'] += 1
+
+    def _exit(self, throttled):
+        with self._cond:
+            self._inFlight -= 1
+            if throttled:
+                self.stats['throttled'] += 1
+                self._successes = 0
+                self._limit = max(1, self._limit // 2)
+                self.bucket.setRate(max(self.maxRate / 10, self.bucket.rate / 2))
+            else:
+                self._successes += 1
+                if self._successes >= self.RECOVERY_CALLS:
+                    self._successes = 0
+                    self._limit = min(self.maxConcurrency, self._limit + 1)
+                    self.bucket.setRate(min(self.maxRate, self.bucket.rate * 1.5))
+            self._cond.notify_all()
+
+    def __call__(self, request):
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            self._enter()
+            throttled = False
+            try:
+                return self.transport(request)
+            except SoftLayer.SoftLayerAPIError as e:
+                throttled = self.isThrottled(e)
+                retry = throttled or (self.isTransient(e) and self.isReadOnly(request))
+                if not retry or attempt >= self.maxRetries:
+                    with self._cond:
+                        self.stats['failures'] += 1
+                    raise
+            finally:
+                self._exit(throttled)
+            # Exponential backoff with (full) jitter before trying again
+            delay = min(self.maxDelay, self.baseDelay * (2 ** attempt))
+            attempt += 1
+            with self._cond:
+                self.stats['retries'] += 1
+            time.sleep(random.uniform(0, delay))
+
 class SoftLayerHelper:
     """Wrapper around the softlayer API"""
 
+    # Number of VLANs retrieved per page when listing all the VLANs
+    VLAN_PAGE_SIZE = 100
+
+    # Number of IPs retrieved per page when iterating over the IPs of a subnet
+    IP_PAGE_SIZE = 256
+
+    # Maximum number of hostnames/tags in the filter of a single device query
+    DEVICE_QUERY_CHUNK_SIZE = 50
+
+    # Number of devices retrieved per page by the device queries
+    DEVICE_PAGE_SIZE = 100
+
+    # Default maximum number of API calls issued concurrently by the helper
+    DEFAULT_MAX_CONCURRENCY = 8
+
+    # Default maximum number of API calls per second
+    DEFAULT_RATE_LIMIT = 20
+
+    # Maximum time (seconds) to wait for the result of a concurrent call.  The wait needs a timeout
+    # on Python 2 to be interrupted by Ctrl-C.
+    CONCURRENT_CALL_TIMEOUT = 24 * 3600
+
     @staticmethod
-    def getSoftLayerClient(userid=None, apikey=None):
+    def iterAll(client, service, method, pageSize, **kwargs):
+        """
+            Iterate over all the items returned by a list method, retrieved one page (of 'pageSize' items)
+            at a time with explicit limit and offset.
+
+            The 'iter=True' paging of the client is not used: before SoftLayer 5.6, its 'limit' caps the
+            total number of items instead of setting the page size.
+        """
+        offset = 0
+        while True:
+            page = client.call(service, method, limit=pageSize, offset=offset, **kwargs) or []
+            for item in page:
+                yield item
+            if len(page) < pageSize:
+                return
+            offset += pageSize
+
+    @staticmethod
+    def getSoftLayerClient(userid=None, apikey=None, poolSize=DEFAULT_MAX_CONCURRENCY, connectTimeout=None, readTimeout=None, rateLimit=DEFAULT_RATE_LIMIT, maxRetries=5):
+        """
+            Create a SoftLayer client that uses a pool of up to 'poolSize' keep-alive connections.  The
+            client can be shared by several threads (i.e. the helper's concurrent workers).
+
+            All the calls of the client go through a RateLimitedTransport (at most 'rateLimit' calls
+            per second, retrying up to 'maxRetries' times on throttling and transient faults).
+
+            The credentials, endpoint, proxy and default (read) timeout are resolved the same way as
+            SoftLayer.create_client_from_env does.
+        """
         if userid is None:
             if 'SL_USER' in os.environ:
                 userid = os.environ['SL_USER']
         if apikey is None:
             if 'SL_APIKEY' in os.environ:
-                userid = os.environ['SL_APIKEY']
+                apikey = os.environ['SL_APIKEY']
+
+        settings = get_client_settings(username=userid, api_key=apikey)
+        transport = PooledXmlRpcTransport(poolSize,
+                                          connectTimeout=connectTimeout,
+                                          readTimeout=readTimeout,
+                                          endpoint_url=settings.get('endpoint_url'),
+                                          proxy=settings.get('proxy'),
+                                          timeout=settings.get('timeout'))
+        transport = RateLimitedTransport(transport, poolSize, rateLimit, maxRetries=maxRetries)
 
         if userid is None and apikey is None:
-            client = SoftLayer.create_client_from_env()
+            client = SoftLayer.create_client_from_env(transport=transport)
         else:
-            client = SoftLayer.create_client_from_env(userid, apikey)
+            client = SoftLayer.create_client_from_env(userid, apikey, transport=transport)
 
         return client
     @staticmethod
@@ -234,19 +644,109 @@ class SoftLayerHelper:
         return False
 
 
-    def __init__(self, userid=None, apikey=None):
-        self.client = self.getSoftLayerClient(userid, apikey)
+    def __init__(self, userid=None, apikey=None, maxConcurrency=DEFAULT_MAX_CONCURRENCY, cache=None, client=None, connectTimeout=None, readTimeout=None, rateLimit=DEFAULT_RATE_LIMIT, maxRetries=5):
+        """
+            If a client is provided (i.e. the pooled client of another helper) it is used as is, otherwise
+            a pooled client is created with enough connections for all the concurrent workers.
+        """
+        if client is None:
+            client = self.getSoftLayerClient(userid, apikey, poolSize=max(maxConcurrency, 1), connectTimeout=connectTimeout, readTimeout=readTimeout, rateLimit=rateLimit, maxRetries=maxRetries)
+        self.client = client
         self.nwmgr = SoftLayer.NetworkManager(self.client)
         self.hwmgr = SoftLayer.HardwareManager(self.client)
+        self.cache = cache
+        self.subnetIndex = SubnetIndex()
+        # Subnets retrieved on the first IP not found in the index (see addSubnetIdsForIPs)
+        self._pendingSubnetIds = []
+        self._pendingSubnetsLock = threading.Lock()
+        self.maxConcurrency = maxConcurrency
+        self._workerState = threading.local()
 
     def getClient(self):
         return self.client
 
-    def getDeviceById(self, id):
-        return Device(self.hwmgr.get_hardware(id,mask=Device.MASK))
+    def getCallStats(self):
+        """
+            Returns the counters of the API calls (calls, retries, throttled, failures) and the current
+            concurrency limit and rate, or None if the client does not go through a RateLimitedTransport.
+        """
+        transport = self.client.transport
+        return transport.getStats() if isinstance(transport, RateLimitedTransport) else None
+
+    def _runInWorker(self, call):
+        self._workerState.inWorker = True
+        try:
+            return call()
+        finally:
+            self._workerState.inWorker = False
+
+    def runConcurrently(self, calls):
+        """
+            Run the calls (a list of functions that take no arguments) using at most 'maxConcurrency'
+            threads and return their results in the same order as the calls.
 
-    def getDeviceByHostname(self, hostname, deviceType=Device.Type.BareMetal, datacenter=None):
-        devices = self.getDevicesByHostname([hostname], deviceType=deviceType, datacenter=datacenter)
+            If any call raises an exception, the exception of the first failing call (in the order of
+            the calls) is raised, the same as if the calls were run one after the other.
+
+            The calls are run in sequence if concurrency is disabled (maxConcurrency <= 1), if there
+            is only one call, or if this is invoked from one of the helper's own worker threads.
+        """
+        inWorker = getattr(self._workerState, 'inWorker', False)
+        if self.maxConcurrency <= 1 or len(calls) <= 1 or inWorker:
+            return [call() for call in calls]
+
+        pool = ThreadPool(min(self.maxConcurrency, len(calls)))
+        try:
+            pending = [pool.apply_async(self._runInWorker, (call,)) for call in calls]
+            results = [result.get(self.CONCURRENT_CALL_TIMEOUT) for result in pending]
+            pool.close()
+            return results
+        except BaseException:
+            # e.g. Ctrl-C or a failing call: the calls not started yet are dropped
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def _cached(self, type, key, loader, cacheable=True):
+        """
+            Return the raw data for the key from the cache (if any), otherwise use the loader to
+            retrieve it and store it in the cache.  If not cacheable, the loader is always used and
+            the data is not stored.
+        """
+        if self.cache is None or not cacheable:
+            return loader()
+        found, value = self.cache.get(type, key)
+        if found:
+            return value
+        value = loader()
+        self.cache.put(type, key, value)
+        return value
+
+    @staticmethod
+    def _isCacheableMask(mask):
+        """The devices retrieved with their credentials (root password) are never written to the cache"""
+        return 'passwords' not in mask
+
+    def getDeviceById(self, id, mask=Device.MASK):
+        key = SoftLayerCache.toKey('id', id, mask)
+        data = self._cached(SoftLayerCache.Type.Device, key, partial(self.hwmgr.get_hardware, id, mask=mask), self._isCacheableMask(mask))
+        return Device(data, partial(self._getDeviceData, Device.Type.BareMetal))
+
+    def _getDeviceData(self, deviceType, id, mask):
+        """
+            Retrieve the fields in the mask for a device.  Used by the devices to load the fields
+            missing from the mask they were retrieved with.
+        """
+        service = 'SoftLayer_Hardware_Server' if deviceType == Device.Type.BareMetal else 'SoftLayer_Virtual_Guest'
+        key = SoftLayerCache.toKey('id', id, mask)
+        return self._cached(SoftLayerCache.Type.Device, key, partial(self.client[service].getObject, id=id, mask=mask), self._isCacheableMask(mask))
+
+    def _toDevice(self, data):
+        return Device(data, partial(self._getDeviceData, Device.Type.getType(data['deviceType'])))
+
+    def getDeviceByHostname(self, hostname, deviceType=Device.Type.BareMetal, datacenter=None, mask=Device.MASK):
+        devices = self.getDevicesByHostname([hostname], deviceType=deviceType, datacenter=datacenter, mask=mask)
 
         if devices:
             if len(devices) == 1:
@@ -258,7 +758,7 @@ class SoftLayerHelper:
                 raise Exception("More than one device found with hostname '%s'. Device ids: %s" % (hostname, ', '.join(ids)))
         return None
 
-    def getDevicesByHostname(self, hostname, deviceType=Device.Type.Any, datacenter=None):
+    def getDevicesByHostname(self, hostname, deviceType=Device.Type.Any, datacenter=None, mask=Device.MASK):
         hostnames = []
         if isinstance(hostname, str):
             # hostname is string
@@ -269,61 +769,24 @@ class SoftLayerHelper:
         else:
             raise Exception( "Unexpected type for 'hostname' parameter: %s" % hostname.__class__)
 
-        result = []
-        # for deviceTag in tags:
-        if deviceType == Device.Type.BareMetal or deviceType == Device.Type.Any:
-            # Look for baretal devices
-            filter = {
-                'hardware': {
-                    'hostname': {
-                        'operation': 'in',
-                        'options': [{
-                            'name': 'data',
-                            'value': hostnames
-                        }]
-                    }
-                }
-            }
-            if datacenter is not None:
-                filter['hardware']['datacenter'] = {
-                    'name': {
-                        'operation': datacenter
-                    }
-                }
-            # slResult = self.client.call('Account', 'getHardware', filter=filter, mask=Device.MASK)
-            slResult = self.hwmgr.list_hardware(filter=filter, mask=Device.MASK)
-            if len(slResult) > 0:
-                for dev in slResult:
-                    result.append(Device(dev))
-        if deviceType == Device.Type.VM or deviceType == Device.Type.Any:
-            # Look for virtual devices
-            filter = {
-                'virtualGuests': {
-                    'hostname': {
-                        'operation': 'in',
-                        'options': [{
-                            'name': 'data',
-                            'value': hostnames
-                        }]
-                    }
+        def hostnameFilter(chunk):
+            return {
+                'hostname': {
+                    'operation': 'in',
+                    'options': [{
+                        'name': 'data',
+                        'value': chunk
+                    }]
                 }
             }
-            if datacenter is not None:
-                filter['virtualGuests']['datacenter'] = {
-                    'name': {
-                        'operation': datacenter
-                    }
-                }
-            slResult = self.client.call('Account', 'getVirtualGuests', filter=filter, mask=Device.MASK)
-            if len(slResult) > 0:
-                for dev in slResult:
-                    result.append(Device(dev))
-            # else:
-            #     print("No results.")
+
+        key = SoftLayerCache.toKey('hostname', hostnames, deviceType, datacenter, mask)
+        slResult = self._cached(SoftLayerCache.Type.Device, key, partial(self._findDevices, hostnameFilter, hostnames, deviceType, datacenter, mask), self._isCacheableMask(mask))
+        result = [self._toDevice(dev) for dev in slResult]
         return result if len(result) > 0 else None
 
 
-    def getDevicesByTag(self, tag, deviceType=Device.Type.Any, datacenter=None):
+    def getDevicesByTag(self, tag, deviceType=Device.Type.Any, datacenter=None, mask=Device.MASK):
         tags = []
         if isinstance(tag, str):
             # Tag is string
@@ -334,67 +797,72 @@ class SoftLayerHelper:
         else:
             raise Exception( "Unexpected type for 'tag' parameter: %s" % tag.__class__)
 
-        result = []
-        # for deviceTag in tags:
-        if deviceType == Device.Type.BareMetal or deviceType == Device.Type.Any:
-            # Look for baretal devices
-            filter = {
-                'hardware': {
-                    'tagReferences': {
-                        'tag': {
-                            'name': {
-                                'operation': 'in',
-                                'options': [{
-                                    'name': 'data',
-                                    'value': tags
-                                }]
-                            }
+        def tagFilter(chunk):
+            return {
+                'tagReferences': {
+                    'tag': {
+                        'name': {
+                            'operation': 'in',
+                            'options': [{
+                                'name': 'data',
+                                'value': chunk
+                            }]
                         }
                     }
                 }
             }
-            if datacenter is not None:
-                filter['hardware']['datacenter'] = {
-                    'name': {
-                        'operation': datacenter
-                    }
-                }
-            slResult = self.client.call('Account', 'getHardware', filter=filter, mask=Device.MASK)
-            if len(slResult) > 0:
-                for dev in slResult:
-                    result.append(Device(dev))
 
-        if deviceType == Device.Type.VM or deviceType == Device.Type.Any:
-            # Look for virtual devices
-            filter = {
-                'virtualGuests': {
-                    'tagReferences': {
-                        'tag': {
+        key = SoftLayerCache.toKey('tag', tags, deviceType, datacenter, mask)
+        slResult = self._cached(SoftLayerCache.Type.Device, key, partial(self._findDevices, tagFilter, tags, deviceType, datacenter, mask), self._isCacheableMask(mask))
+        result = [self._toDevice(dev) for dev in slResult]
+        return result if len(result) > 0 else None
+
+    def _findDevices(self, buildFilter, values, deviceType=Device.Type.Any, datacenter=None, mask=Device.MASK):
+        """
+            Retrieve the raw data of the baremetal and/or virtual devices matching any of the values.
+
+            The values are split in chunks of (at most) DEVICE_QUERY_CHUNK_SIZE. The query for each chunk
+            and device type pages through the results and all the queries run concurrently.  The devices
+            found are returned once, even if matched by several chunks (i.e. devices with several tags).
+            The devices are identified by their type and id.
+
+            The 'buildFilter' function returns the filter clauses of the device for a chunk of values.
+            The type of each device is added to its data (as 'deviceType').
+        """
+        deviceQueries = [
+            (Device.Type.BareMetal, 'getHardware', 'hardware'),
+            (Device.Type.VM, 'getVirtualGuests', 'virtualGuests')
+        ]
+        calls = []
+        for start in range(0, len(values), self.DEVICE_QUERY_CHUNK_SIZE):
+            chunk = values[start:start + self.DEVICE_QUERY_CHUNK_SIZE]
+            for queryType, method, objectName in deviceQueries:
+                if deviceType == queryType or deviceType == Device.Type.Any:
+                    filter = buildFilter(chunk)
+                    if datacenter is not None:
+                        filter['datacenter'] = {
                             'name': {
-                                'operation': 'in',
-                                'options': [{
-                                    'name': 'data',
-                                    'value': tags
-                                }]
+                                'operation': datacenter
                             }
                         }
-                    }
-                }
-            }
-            if datacenter is not None:
-                filter['virtualGuests']['datacenter'] = {
-                    'name': {
-                        'operation': datacenter
-                    }
-                }
-            slResult = self.client.call('Account', 'getVirtualGuests', filter=filter, mask=Device.MASK)
-            if len(slResult) > 0:
-                for dev in slResult:
-                    result.append(Device(dev))
-            # else:
-            #     print("No results.")
+                    calls.append(partial(self._listDevices, queryType, method, {objectName: filter}, mask))
 
-        return result if len(result) > 0 else None
+        result = []
+        # The baremetal and virtual devices have separate ids, so the same id can be one of each
+        deviceKeys = set()
+        for slResult in self.runConcurrently(calls):
+            for dev in slResult:
+                deviceKey = (dev['deviceType'], dev['id'])
+                if deviceKey not in deviceKeys:
+                    deviceKeys.add(deviceKey)
+                    result.append(dev)
+        return result
+
+    def _listDevices(self, deviceType, method, filter, mask):
+        devices = list(self.iterAll(self.client, 'Account', method, self.DEVICE_PAGE_SIZE, filter=filter, mask=mask))
+        for dev in devices:
+            dev['deviceType'] = deviceType.value
+        return devices
 
     def attachVlansToNetworkGateway(self, gatewayId, vlanIds, bypass):
         """
@@ -421,10 +889,11 @@ class SoftLayerHelper:
         """
             Retrieve a list of VLANs. Optionally, filter the type of subnets included in each VLAN.
         """
-        slVlans = self.nwmgr.list_vlans()
+        slVlans = self.iterAll(self.client, 'Account', 'getNetworkVlans', self.VLAN_PAGE_SIZE, mask=VLAN.MASK)
         vlans = []
         for vlan in slVlans:
-            vlans.append(self.getVlan(vlan['id'],subnetType, addressSpace))
+            vlans.append(VLAN(vlan, subnetType=subnetType, addressSpace=addressSpace))
+            self.addKnownSubnets(vlans[-1].subnets)
         return vlans if len(vlans) > 0 else None
 
     def getVlan(self, idOrName, subnetType=Subnet.Type.Any, addressSpace=Subnet.AddressSpace.Any):
@@ -434,25 +903,121 @@ class SoftLayerHelper:
             vlan = None
             idIsNumber = True
             if isinstance(idOrName, numbers.Number):
-                vlan = self.nwmgr.get_vlan(idOrName)
+                vlan = self._getCachedVlanData(idOrName, subnetType, addressSpace)
             elif isinstance(idOrName, str):
                 idIsNumber = False
-                slVlans = self.nwmgr.list_vlans(name=idOrName,mask=VLAN.MASK)
-                vlan = self.nwmgr.get_vlan(slVlans[0]['id']) if len(slVlans) else None
+                slVlans = self.nwmgr.list_vlans(name=idOrName,mask='id')
+                vlan = self._getCachedVlanData(slVlans[0]['id'], subnetType, addressSpace) if len(slVlans) else None
             else:
                 raise Exception( "Unexpected type for 'idOrName' parameter: %s" % idOrName.__class__ )
 
-            return VLAN(vlan, subnetType=subnetType, addressSpace=addressSpace) if vlan else None
+            if vlan is None:
+                return None
+            vlan = VLAN(vlan, subnetType=subnetType, addressSpace=addressSpace)
+            self.addKnownSubnets(vlan.subnets)
+            return vlan
         except SoftLayer.SoftLayerAPIError as e:
             if self.isAPIError_ObjNotFound(e):
                 raise ObjectNotFoundException("VLAN with {} '{}' not found.".format("id" if idIsNumber else "name", idOrName))
             raise e
 
+    def _getCachedVlanData(self, id, subnetType=Subnet.Type.Any, addressSpace=Subnet.AddressSpace.Any):
+        key = SoftLayerCache.toKey(id, subnetType, addressSpace)
+        return self._cached(SoftLayerCache.Type.Vlan, key, partial(self._getVlanData, id, subnetType, addressSpace))
+
+    def _getVlanData(self, id, subnetType=Subnet.Type.Any, addressSpace=Subnet.AddressSpace.Any):
+        """
+            Retrieve the raw VLAN data by id.  When a subnet type and/or address space is specified,
+            only the matching subnets are retrieved (filtered by the API).
+        """
+        vlanService = self.client['SoftLayer_Network_Vlan']
+        subnetFilter = Subnet.getFilter(subnetType, addressSpace)
+        if subnetFilter is None:
+            return vlanService.getObject(id=id, mask=VLAN.MASK)
+
+        vlan, subnets = self.runConcurrently([
+            partial(vlanService.getObject, id=id, mask=VLAN.BASE_MASK),
+            partial(vlanService.getSubnets, id=id, filter={'subnets': subnetFilter}, mask=Subnet.MASK)
+        ])
+        if vlan:
+            vlan['subnets'] = subnets
+        return vlan
+
+    def addKnownSubnets(self, subnets):
+        """
+            Add subnets to the index used by getSubnetForIP.
+        """
+        for subnet in subnets:
+            self.subnetIndex.add(subnet)
+
+    def addSubnetIdsForIPs(self, ids):
+        """
+            Register subnets by id for getSubnetForIP.  They are only retrieved (concurrently) the first
+            time an IP is not found in the subnets already known, so the commands that do not look up
+            any IP do not retrieve them.
+        """
+        with self._pendingSubnetsLock:
+            self._pendingSubnetIds.extend(ids)
+
+    def _loadPendingSubnets(self):
+        """
+            Retrieve the subnets registered by addSubnetIdsForIPs, if not done yet.  Returns True if
+            some were retrieved.
+        """
+        # The lock is held during the load, so the concurrent lookups wait for it instead of calling the API
+        with self._pendingSubnetsLock:
+            ids = self._pendingSubnetIds
+            self._pendingSubnetIds = []
+            if ids:
+                self.loadSubnets(ids)
+        return len(ids) > 0
+
+    def loadSubnets(self, ids):
+        """
+            Retrieve the subnets by id (concurrently) and add them to the index used by getSubnetForIP.
+            Subnets that do not exist are skipped.
+
+            Returns the list of subnets found.
+        """
+        subnets = self.runConcurrently([partial(self._getSubnetIfExists, id) for id in ids])
+        return [subnet for subnet in subnets if subnet is not None]
+
+    def _getSubnetIfExists(self, id):
+        try:
+            return self.getSubnet(id)
+        except ObjectNotFoundException:
+            return None
+
     def getSubnetForIP(self, ip):
-        subnetHelper = self.client['SoftLayer_Network_Subnet']
-        subnet = subnetHelper.getSubnetForIpAddress(ip,mask=Subnet.MASK)
+        """
+            Retrieve the subnet of an IP.  The subnets already known by the helper (retrieved by id, in a
+            VLAN or by a previous call) are looked up first, then the subnets registered by
+            addSubnetIdsForIPs.  The API is only called if none contains the IP.
 
-        return Subnet(subnet)
+            If no subnet of the account contains the IP, then ObjectNotFoundException is raised.
+        """
+        subnet = self.subnetIndex.find(ip)
+        if subnet is not None:
+            return subnet
+        if self._loadPendingSubnets():
+            subnet = self.subnetIndex.find(ip)
+            if subnet is not None:
+                return subnet
+
+        subnetHelper = self.client['SoftLayer_Network_Subnet']
+        key = SoftLayerCache.toKey(ip)
+        try:
+            subnetData = self._cached(SoftLayerCache.Type.SubnetForIP, key, partial(subnetHelper.getSubnetForIpAddress, ip, mask=Subnet.MASK))
+        except SoftLayer.SoftLayerAPIError as e:
+            if self.isAPIError_ObjNotFound(e):
+                subnetData = None
+            else:
+                raise e
+        if not subnetData:
+            raise ObjectNotFoundException("No subnet found for IP '{}'.".format(ip))
+        subnet = Subnet(subnetData)
+        self.subnetIndex.add(subnet)
+        return subnet
 
     def findIpById(self, id):
         """
@@ -489,7 +1054,8 @@ class SoftLayerHelper:
         }
         subnetHelper = self.client['SoftLayer_Network_Subnet']
         try:
-            result = subnetHelper.getIpAddresses(id=id,filter=filter,mask=IpAddress.MASK)
+            key = SoftLayerCache.toKey(id, filter)
+            result = self._cached(SoftLayerCache.Type.IPs, key, partial(subnetHelper.getIpAddresses, id=id, filter=filter, mask=IpAddress.MASK))
 
             if len(result) == 0:
                 return None
@@ -503,6 +1069,52 @@ class SoftLayerHelper:
                 raise ObjectNotFoundException("Subnet with id '{}' not found.".format(id))
             raise e
 
+    def findIpsByNotesInSubnet(self, id, notes):
+        """
+            Searches in a subnet for the IPs with any of the specified notes/comments using a single call.
+
+            Returns a dict with the note as the key and the matching IP as the value.  Notes with no
+            matching IP are mapped to None.
+
+            If no subnet found by Id, then an ObjectNotFoundException is raised.
+
+            If more than one matching IPs are found for a note, then a MoreThanOneMatchFoundException is raised.
+        """
+        result = {}
+        for note in notes:
+            result[note] = None
+        if len(result) == 0:
+            return result
+
+        filter = {
+            'ipAddresses': {
+                'note': {
+                    'operation': 'in',
+                    'options': [{
+                        'name': 'data',
+                        'value': list(result.keys())
+                    }]
+                }
+            }
+        }
+        subnetHelper = self.client['SoftLayer_Network_Subnet']
+        try:
+            key = SoftLayerCache.toKey(id, filter)
+            ips = self._cached(SoftLayerCache.Type.IPs, key, partial(subnetHelper.getIpAddresses, id=id, filter=filter, mask=IpAddress.MASK))
+
+            for ipdata in ips:
+                ipAddr = IpAddress(ipdata)
+                if ipAddr.note not in result:
+                    continue
+                if result[ipAddr.note] is not None:
+                    raise MoreThanOneMatchFoundException("More than one IP found with this note text: %s" % ipAddr.note )
+                result[ipAddr.note] = ipAddr
+            return result
+        except SoftLayer.SoftLayerAPIError as e:
+            if self.isAPIError_ObjNotFound(e):
+                raise ObjectNotFoundException("Subnet with id '{}' not found.".format(id))
+            raise e
+
     def setIpNote(self, ip_id, note):
         """
             Set the comment of an IP (by ID).  To clear the note, specify empty string ''.
@@ -516,13 +1128,95 @@ class SoftLayerHelper:
             'note': note,
         }
         try:
-            return self.client['SoftLayer_Network_Subnet_IpAddress'].editObject(ip,id=ip_id)
+            updated = self.client['SoftLayer_Network_Subnet_IpAddress'].editObject(ip,id=ip_id)
+            # The note is part of the IP lookups, so they are no longer valid
+            if self.cache is not None:
+                self.cache.invalidate(SoftLayerCache.Type.IPs)
+            return updated
             # return True
         except SoftLayer.SoftLayerAPIError as e:
             if self.isAPIError_ObjNotFound(e):
                 return False
             raise e
 
+    def reserveIpsInSubnet(self, subnet, notes):
+        """
+            Reserve an IP in the subnet for each note (i.e. hostname) by setting it as the note of a free IP.
+
+            The IPs of the subnet are read once to build a bitmap of the free addresses, that is excluding
+            the network, gateway, broadcast and reserved addresses, the ones in use by a device and the
+            ones that already have a note.  Notes that already have an IP keep it.  The free addresses are
+            allocated in order in a single pass and the notes are then written concurrently.
+
+            Returns a dict with the note as the key and the IP as the value.
+
+            If there are not enough free IPs, a SoftLayerHelperException is raised before any IP is updated.
+
+            If some of the notes cannot be set, the others are still set and a PartialReservationException
+            is raised with the IPs reserved and the reason of each failure.  Reserving again only sets the
+            notes that failed, since the notes that have an IP keep it.
+
+            If more than one IP is found with one of the notes, then a MoreThanOneMatchFoundException is raised.
+        """
+        result = {}
+        for note in notes:
+            result[note] = None
+
+        network = aton(subnet.network)
+        free = bytearray(2 ** (32 - subnet.cidr))
+        freeIps = {}
+        for ipAddr in self.iterIPsInSubnet(subnet.id):
+            if ipAddr.note in result:
+                if result[ipAddr.note] is not None:
+                    raise MoreThanOneMatchFoundException("More than one IP found with this note text: %s" % ipAddr.note )
+                result[ipAddr.note] = ipAddr
+            elif ipAddr.status == IpAddress.Status.Other and not ipAddr.note:
+                offset = aton(ipAddr.value) - network
+                free[offset] = 1
+                freeIps[offset] = ipAddr
+
+        # Allocate the free addresses in the order of the notes
+        pending = []
+        pendingNotes = set()
+        for note in notes:
+            if result[note] is None and note not in pendingNotes:
+                pending.append(note)
+                pendingNotes.add(note)
+        allocated = []
+        offset = 0
+        for note in pending:
+            while offset < len(free) and not free[offset]:
+                offset += 1
+            if offset >= len(free):
+                raise SoftLayerHelperException("Not enough free IPs in subnet %s. Free IPs: %s, IPs to reserve: %s" % (subnet.name, len(freeIps), len(pending)))
+            allocated.append((note, freeIps[offset]))
+            offset += 1
+
+        errors = self.runConcurrently([partial(self._trySetIpNote, ipAddr, note) for note, ipAddr in allocated])
+        failed = {}
+        for (note, ipAddr), error in zip(allocated, errors):
+            if error is None:
+                ipAddr.note = note
+                result[note] = ipAddr
+            else:
+                failed[note] = "Unable to set the note on IP %s: %s" % (ipAddr.value, error)
+                del result[note]
+        if len(failed) > 0:
+            raise PartialReservationException("Unable to set %s of the %s IP notes" % (len(failed), len(allocated)), result, failed)
+        return result
+
+    def _trySetIpNote(self, ipAddr, note):
+        """
+            Set the note of the IP.  Returns None if it was set or the reason it was not, so the other
+            notes set concurrently are still reported.
+        """
+        try:
+            if self.setIpNote(ipAddr.id, note):
+                return None
+            return "IP not found"
+        except Exception as e:
+            return str(e)
+
     def getSubnet(self, id):
         """
             Retrieve subnet details based on id.
@@ -530,8 +1224,13 @@ class SoftLayerHelper:
             If no subnet with specified id is found, then ObjectNotFoundException is raised.
         """
         try:
-            subnetData = self.client['SoftLayer_Network_Subnet'].getObject(id=id, mask=Subnet.MASK)
-            return Subnet(subnetData) if subnetData else None
+            key = SoftLayerCache.toKey(id)
+            subnetData = self._cached(SoftLayerCache.Type.Subnet, key, partial(self.client['SoftLayer_Network_Subnet'].getObject, id=id, mask=Subnet.MASK))
+            if not subnetData:
+                return None
+            subnet = Subnet(subnetData)
+            self.subnetIndex.add(subnet)
+            return subnet
         except SoftLayer.SoftLayerAPIError as e:
             if self.isAPIError_ObjNotFound(e):
                 raise ObjectNotFoundException("Subnet with id '{}' not found.".format(id))
@@ -547,8 +1246,13 @@ class SoftLayerHelper:
             If the subnet is found, then either an array of matching IP objects are returned, or None if no matched IPs found.
         """
         subnet = self.client['SoftLayer_Network_Subnet']
+        ipFilter = IpAddress.getFilter(type, status)
         try:
-            ips = subnet.getIpAddresses(id=id,mask=IpAddress.MASK)
+            key = SoftLayerCache.toKey(id, ipFilter)
+            if ipFilter:
+                ips = self._cached(SoftLayerCache.Type.IPs, key, partial(subnet.getIpAddresses, id=id, filter={'ipAddresses': ipFilter}, mask=IpAddress.MASK))
+            else:
+                ips = self._cached(SoftLayerCache.Type.IPs, key, partial(subnet.getIpAddresses, id=id, mask=IpAddress.MASK))
             result = []
             for ipdata in ips:
                 ipAddr = IpAddress(ipdata)
@@ -561,6 +1265,35 @@ class SoftLayerHelper:
                 # return None
             raise e
 
+    def iterIPsInSubnet(self, id, type=None, status=None, pageSize=IP_PAGE_SIZE):
+        """
+            Iterate over the IPs of a subnet. Optionally, filter the IPs by either status and/or type.
+
+            The IPs are retrieved one page (of 'pageSize' IPs) at a time, as they are consumed, so only
+            one page is kept in memory and the caller can stop as soon as it found what it needs.
+
+            If no subnet with provided id is found, then ObjectNotFoundException is raised (when the
+            first page is retrieved).
+        """
+        subnet = self.client['SoftLayer_Network_Subnet']
+        ipFilter = IpAddress.getFilter(type, status)
+        filter = {'ipAddresses': ipFilter} if ipFilter else None
+        offset = 0
+        while True:
+            try:
+                page = subnet.getIpAddresses(id=id, filter=filter, mask=IpAddress.MASK, limit=pageSize, offset=offset)
+            except SoftLayer.SoftLayerAPIError as e:
+                if self.isAPIError_ObjNotFound(e):
+                    raise ObjectNotFoundException("Subnet with id '{}' not found.".format(id))
+                raise e
+            for ipdata in page:
+                ipAddr = IpAddress(ipdata)
+                if (type == None or ipAddr.type == type) and (status == None or ipAddr.status == status):
+                    yield ipAddr
+            if len(page) < pageSize:
+                return
+            offset += pageSize
+
     def findIpInfoByNoteInVlan(self, idNameOrVlan, note, subnetType=Subnet.Type.Any, addressSpace=Subnet.AddressSpace.Any):
         """
             Searches for an ip in a vlan (by name,id or vlan object) based on its "comment" on particular subnet
@@ -589,8 +1322,9 @@ class SoftLayerHelper:
         if searchVlan:
             result_ips = []
             result_subnets = []
-            for subnet in searchVlan.subnets:
-                ip = self.findIpByNoteInSubnet(subnet.id, note)
+            # Search all the subnets at the same time
+            ips = self.runConcurrently([partial(self.findIpByNoteInSubnet, subnet.id, note) for subnet in searchVlan.subnets])
+            for subnet, ip in zip(searchVlan.subnets, ips):
                 if ip:
                     result_ips.append(ip)
                     result_subnets.append(subnet)
@@ -106,24 +106,36 @@ class Templates:
         try:
             with open(template, 'r') as fpIn:
                 for line in fpIn:
-                    outline = line = line.rstrip()
-                    lineVars = None
-                    lineVars = _getVars(outline, varIdentifier)
-
-                    if lineVars:
-                        for var in lineVars:
-                            token = "%s%s%s" % (varIdentifier, var, varIdentifier)
-                            value = ""
-                            if var in varsToUse:
-                                valueToUse = varsToUse[var]
-                                if isinstance(valueToUse, basestring):
-                                    value = valueToUse
-                            outline = outline.replace(token,value)
-                    outStream.write("%s\n" % outline)
+                    outStream.write("%s\n" % Templates.mergeLine(line.rstrip(), varsToUse, varIdentifier))
         finally:
             if fpIn:
                 fpIn.close()
     
+    @staticmethod
+    def mergeLine(line, vars, varIdentifier=DEFAULT_IDENTIFIER):
+        """
+        Replace the variables in a line of text.  Unknown variables, or variables with a value that is
+        not a string, are replaced by an empty string.
+
+         @type line: str
+         @param line: the text to merge
+
+         @type vars: dict
+         @param vars: the variables to replace in the line
+        """
+        lineVars = _getVars(line, varIdentifier)
+
+        if lineVars:
+            for var in lineVars:
+                token = "%s%s%s" % (varIdentifier, var, varIdentifier)
+                value = ""
+                if var in vars:
+                    valueToUse = vars[var]
+                    if isinstance(valueToUse, basestring):
+                        value = valueToUse
+                line = line.replace(token,value)
+        return line
+
     @staticmethod
     def loadPropertyFile(propFile):
         """
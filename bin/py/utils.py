@@ -1,7 +1,10 @@
 import os
+import stat
 import binascii
 import struct
 import socket
+import hashlib
+import tempfile
 
 def tokenize(line):
     tokens = line.split(' ')
@@ -14,6 +17,20 @@ def tokenize(line):
     
     return outTokens
 
+def jsonToStr(value):
+    """
+    Returns the value decoded from JSON with its unicode strings turned back into (utf-8) str, the type
+    of the strings read from the SoftLayer API and from the configuration.  Lists and dicts are converted
+    recursively.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [jsonToStr(item) for item in value]
+    if isinstance(value, dict):
+        return dict((jsonToStr(k), jsonToStr(v)) for k, v in value.items())
+    return value
+
 def fileToString(filename):
     """Read a file into a string.  Closes the input file stream."""
     open(filename,'r').read()
@@ -24,12 +41,78 @@ def fileToString(filename):
         stream.close()
 
 def stringToFile(filename, string):
-    """Write a string to a file."""
+    """Write a string to a file (atomically).  Returns True if the content of the file changed."""
+    return writeFileAtomically(filename, lambda stream: stream.write(string))
+
+class HashingWriter:
+    """Stream wrapper computing the hash of the content written through it."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        self.stream.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+def fileHash(filename, blockSize=65536):
+    """Returns the hash (sha256) of the content of a file, or None if the file does not exist."""
+    if not os.path.isfile(filename):
+        return None
+    hash = hashlib.sha256()
+    with open(filename, 'rb') as stream:
+        for block in iter(lambda: stream.read(blockSize), b''):
+            hash.update(block)
+    return hash.hexdigest()
+
+def writeFileAtomically(filename, writer, mode=0o644):
+    """
+    Write a file through a temporary file in the same directory, which is fsynced and then renamed
+    over the file.  A concurrent reader (or a crash) never sees a partially written file.
+
+    When the content is the same as the current file's one (compared by hash), the file is left
+    untouched.
+
+     @type filename: str
+     @param filename: the file to write
+
+     @type writer: function
+     @param writer: function called with the stream to write the content to
+
+     @type mode: int
+     @param mode: the permissions of the file if it does not exist yet.  An existing file keeps its own.
+
+     @rtype bool: True if the content of the file changed
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmpFilename = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.', dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            hashingStream = HashingWriter(stream)
+            writer(hashingStream)
+            stream.flush()
+            if hashingStream.hexdigest() == fileHash(filename):
+                os.remove(tmpFilename)
+                return False
+            os.fsync(stream.fileno())
+        if os.path.exists(filename):
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+        os.chmod(tmpFilename, mode)
+        os.rename(tmpFilename, filename)
+    except:
+        if os.path.exists(tmpFilename):
+            os.remove(tmpFilename)
+        raise
+
+    # Make the rename itself durable
+    dirFd = os.open(dirname, os.O_RDONLY)
     try:
-        outFile = open(filename, "w")
-        outFile.write(string)
+        os.fsync(dirFd)
     finally:
-        outFile.close()
+        os.close(dirFd)
+    return True
 
 def aton(addr):
     return struct.unpack('!I', socket.inet_aton(addr))[0]